@@ -13,63 +13,145 @@ import sys
 import json
 import time
 import base64
+import hashlib
+import hmac
+import struct
 import socket
+import selectors
+import errno
 import subprocess
 import platform
 import random
 import logging
 import threading
-import urllib.request
-import urllib.error
+import importlib
+import importlib.util
+import argparse
+import contextlib
+import re
+import resource
+import urllib.parse
 import shutil
-from typing import List, Tuple, Optional, Dict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import bisect
+import itertools
+import heapq
+import math
+import ipaddress
+import signal
+import shlex
+from array import array
+from typing import List, Tuple, Optional, Dict, Iterable, Callable
+from collections import deque
 from dataclasses import dataclass
 
+# --- Lazy Dependencies ---
+class LazyModule:
+    """Module proxy that imports on first attribute access, so each command only pays for what it uses."""
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self._name), attr)
+        setattr(self, attr, value)
+        return value
+
+np = LazyModule("numpy")
+icmplib = LazyModule("icmplib")
+x25519 = LazyModule("cryptography.hazmat.primitives.asymmetric.x25519")
+aead = LazyModule("cryptography.hazmat.primitives.ciphers.aead")
+serialization = LazyModule("cryptography.hazmat.primitives.serialization")
+asyncio = LazyModule("asyncio")
+multiprocessing = LazyModule("multiprocessing")
+sqlite3 = LazyModule("sqlite3")
+cProfile = LazyModule("cProfile")
+tracemalloc = LazyModule("tracemalloc")
+
+# import name -> pip package
+DEPENDENCIES = {"rich": "rich", "icmplib": "icmplib", "cryptography": "cryptography", "numpy": "numpy"}
+
+def missing_dependencies(modules: Iterable[str]) -> List[str]:
+    return [DEPENDENCIES[m] for m in modules if importlib.util.find_spec(m) is None]
+
 # --- Smart Dependency Installer ---
-try:
-    from rich.console import Console
-    from rich.panel import Panel
-    from rich.progress import Progress, BarColumn, TimeRemainingColumn, TextColumn
-    from rich.table import Table
-    from rich.prompt import Prompt
-    from rich.markdown import Markdown
-    from icmplib import multiping, ping
-    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
-    from cryptography.hazmat.primitives import serialization
-    import psutil
-    import requests
-    import yaml
-    from alive_progress import alive_bar
-except ImportError:
+def ensure_dependencies(modules: Iterable[str]):
+    packages = missing_dependencies(modules)
+    if not packages:
+        return
     print("\n📦 Installing required dependencies...")
     try:
-        subprocess.check_call([sys.executable, "-m", "pip", "install",
-                               "rich", "icmplib", "cryptography", "psutil", "requests",
-                               "pyyaml", "alive_progress"])
+        subprocess.check_call([sys.executable, "-m", "pip", "install", *packages])
         print("\n✅ Dependencies installed successfully. Restarting script...")
         os.execv(sys.executable, [sys.executable] + sys.argv)
     except subprocess.CalledProcessError as e:
         print(f"\n❌ Failed to install dependencies: {e}")
-        print("Please install manually: pip install rich icmplib cryptography psutil requests pyyaml alive_progress")
+        print(f"Please install manually: pip install {' '.join(packages)}")
         sys.exit(1)
 
 # --- Global Configuration ---
-console = Console()
 VERSION = "7.0.0"
 CONFIG_FILE = "warpfusion_config.json"
 WARP_CONF_DIR = "warp_profiles"
 LOG_DIR = "warp_logs"
+HISTORY_FILE = "warp_history.db"
 WARP_CONF_PREFIX = "warpfusion_elite"
 TEST_URL = "http://www.gstatic.com/generate_204"
 CF_API = "https://api.cloudflareclient.com/v0a3596/reg"
 USER_AGENT = "okhttp/3.12.1"
 API_TIMEOUT = 10
 MAX_API_RETRIES = 5
+KEY_POOL_FILE = "warp_keys.json"
 PING_COUNT = 4
+PING_INTERVAL = 0.5
+DEEP_SCAN_HOSTS = 30
 PING_TIMEOUT = 2.0
 PORT_SCAN_TIMEOUT = 1.0
 SCAN_THREADS = 100
+ENGINE_MAX_INFLIGHT = 2048
+ENGINE_SOCKETS = 4
+ENGINE_TICK = 0.01
+ENGINE_WHEEL_SLOTS = 1024
+ENGINE_RCVBUF = 4 * 1024 * 1024
+ENGINE_RECV_SIZE = 2048
+EXIT_OK = 0
+EXIT_NO_RESULTS = 1
+EXIT_ERROR = 3
+EXIT_INTERRUPTED = 130
+CONTROLLER_RTT_WINDOW = 512
+CONTROLLER_DECISION_LOG = 1024
+CONTROLLER_RTT_SLACK_MS = 5.0
+CONTROLLER_MIN_TAIL_SAMPLES = 32
+IP_PMTUDISC_DO = 2
+MTU_PROBE_MIN = 1200
+MTU_PROBE_MAX = 1472
+WG_TRANSPORT_OVERHEAD = 32
+WG_CONSTRUCTION = b"Noise_IKpsk2_25519_ChaChaPoly_BLAKE2s"
+WG_IDENTIFIER = b"WireGuard v1 zx2c4 Jason@zx2c4.com"
+WG_LABEL_MAC1 = b"mac1----"
+WG_MSG_INITIATION = 1
+WG_MSG_RESPONSE = 2
+WG_INITIATION_SIZE = 148
+WG_RESPONSE_SIZE = 92
+WG_PROBE_POOL = 8
+TARGET_FEISTEL_ROUNDS = 4
+SCORE_WEIGHTS = (0.6, 0.3, 0.1)
+CANDIDATE_FACTOR = 5
+PROGRESS_BATCH = 256
+SHARD_RECORD = struct.Struct("!16sHHdf")  # address (IPv4-mapped for v4), port, errno, sent_at, rtt_ms (NaN = none)
+SHARD_BATCH = 1024
+V4_MAPPED = b"\x00" * 10 + b"\xff\xff"
+BENCH_NETWORK = "127.42.0.0/16"
+HISTORY_FLUSH_EVERY = 4096
+TRACE_MAGIC = b"WPTR\x01"
+TRACE_RECORD = struct.Struct("<16sHHBdf")  # address (IPv4-mapped for v4), port, errno, phase, sent_at, rtt_ms (NaN = none)
+TRACE_PHASES = ("discover", "measure")
+TRACE_BATCH = 4096
+V6_COVERAGE_FILE = "warp_v6_coverage.bin"
+V6_COVERAGE_MAGIC = b"WV6C"
+V6_MAX_STRATA_BITS = 24
+V6_MAX_RESPONSIVE = 4096
+METRICS_PREFIX = "warpscanner"
+METRICS_LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
 SUPPORTED_PROTOCOLS = ["WireGuard", "Hysteria", "V2Ray", "Sing-box"]
 
 WARP_PORTS = [500, 854, 859, 864, 878, 880, 890, 891, 894, 903, 908, 934, 939, 943, 945, 946, 955, 968, 987, 1002, 1007, 1010, 1014, 1018, 1027, 1032, 1048, 1054, 1074, 1180, 1387, 1701, 2371, 2408, 2506, 3138, 3476, 3581, 4177, 4198, 4233, 4500, 5279, 5956, 7106, 7152, 7159, 7281, 7559, 8319, 8784, 8854, 8886]
@@ -81,6 +163,10 @@ WARP_ENDPOINTS = [
     "2606:4700:4700::1111", "2606:4700:4700::1001"
 ]
 
+WARP_RANGES = ["162.159.192.0/22", "188.114.96.0/22"]
+
+WARP_V6_PREFIXES = ["2606:4700:d0::/96", "2606:4700:d1::/96"]
+
 DEFAULT_CONFIG = {
     "core": {
         "test_url": TEST_URL,
@@ -95,7 +181,29 @@ DEFAULT_CONFIG = {
         "mux": {"enabled": True, "concurrency": 8}
     },
     "wireguard": {"mtu": 1280, "keepalive": 25},
-    "scan": {"timeout": 2, "max_threads": 100}
+    "mtu": {"enabled": True, "probe": "icmp", "min_payload": MTU_PROBE_MIN, "max_payload": MTU_PROBE_MAX, "granularity": 8,
+            "tries": 3, "timeout": 1.0, "cache_ttl": 86400},
+    "scan": {"timeout": 2, "max_inflight": ENGINE_MAX_INFLIGHT, "sockets": ENGINE_SOCKETS, "rate": 0, "probe": "ping",
+             "mode": "endpoints", "endpoints": WARP_ENDPOINTS, "ranges": WARP_RANGES, "top_n": 10, "samples": 8,
+             "strategy": "halving", "halving_eta": 2, "workers": 1, "pipeline": True,
+             "stable_for": 0, "live": True},
+    "adaptive": {"enabled": True, "min_inflight": 16, "max_inflight": 4096, "initial_inflight": 1024,
+                 "min_rate": 50, "max_rate": 50000, "initial_rate": 2000, "increase_inflight": 64,
+                 "increase_rate": 200, "decrease": 0.5, "interval": 0.25, "loss_tolerance": 0.2,
+                 "rtt_inflation": 2.0, "min_timeout": 0.25, "max_timeout": 4.0, "log_decisions": False},
+    "scoring": {"latency": SCORE_WEIGHTS[0], "loss": SCORE_WEIGHTS[1], "jitter": SCORE_WEIGHTS[2],
+                "latency_metric": "mean", "percentile": 90},
+    "history": {"enabled": True, "path": HISTORY_FILE, "ewma_alpha": 0.3, "dead_ttl": 3600,
+                "promising_limit": 512, "stale_after": 900, "incremental": True},
+    "ipv6": {"prefixes": WARP_V6_PREFIXES, "stratum": 112, "budget": 100, "explore": 0.7, "neighbors": 4,
+             "coverage_file": V6_COVERAGE_FILE, "bloom_bits": 1 << 20, "bloom_hashes": 4},
+    "monitor": {"interval": 5.0, "samples": 3, "window": 4, "standby": 4, "timeout": 1.0, "max_latency": 300,
+                "max_loss": 30, "fail_after": 2, "rescan_interval": 900, "reload_command": ""},
+    "registration": {"api": CF_API, "workers": 8, "rate": 4.0, "burst": 8, "pool_file": KEY_POOL_FILE},
+    "metrics": {"prometheus_file": "", "json_file": "", "profile": False, "tracemalloc": False},
+    "trace": {"record_file": ""},
+    "export": {"dir": os.path.join(WARP_CONF_DIR, "fleet"), "formats": ["wg", "sing-box", "v2ray"], "per_key": 1,
+               "workers": 16}
 }
 
 @dataclass
@@ -115,14 +223,1782 @@ class ScanResult:
     packet_loss: float
     jitter: float
     score: float = 0.0
+    mtu: Optional[int] = None
+
+def write_atomic(path: str, text, mode: Optional[int] = None):
+    # Readers (node_exporter, wg-quick, a proxy reload) may open the file at any moment;
+    # write a sibling temp file and rename it over the target so they never see a partial one.
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with (open(tmp, "wb") if isinstance(text, bytes) else open(tmp, "w", encoding="utf-8")) as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+# --- Scan Metrics ---
+class ScanMetrics:
+    """Per-run counters, gauges and timings, exported as a Prometheus textfile or JSON snapshot.
+
+    The scan engine bumps plain attributes on every probe so the hot path stays cheap.
+    ``phase(name)`` accumulates wall and CPU time per scan phase; a large gap between the two
+    means the run was waiting on the network rather than on Python. With ``profile`` each
+    outermost phase runs under a cProfile kept per phase name, so repeated phases accumulate,
+    and ``dump_profiles()`` writes them to ``profile_dir``; with ``trace_memory`` the peak
+    traced allocation of each phase is kept. ``strategy_report`` holds the successive-halving
+    summary (probes spent and saved) of the last ranking.
+    """
+
+    def __init__(self, profile: bool = False, trace_memory: bool = False, profile_dir: str = LOG_DIR,
+                 latency_buckets: Iterable[float] = METRICS_LATENCY_BUCKETS):
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.latency_buckets = list(latency_buckets)
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.probes_sent = 0
+        self.replies = 0
+        self.timeouts = 0
+        self.errors: Dict[int, int] = {}
+        self.inflight_max = 0
+        self.latency_counts = [0] * (len(self.latency_buckets) + 1)
+        self.latency_sum = 0.0
+        self.worker_cpu_s = 0.0
+        self.worker_max_rss_kb = 0
+        self.strategy_report: Dict = {}
+        self.phases: Dict[str, Dict[str, float]] = {}
+        self.profiles: Dict[str, str] = {}
+        self._profilers: Dict[str, cProfile.Profile] = {}
+        self._depth = 0
+
+    def state(self) -> Dict:
+        return {"probes_sent": self.probes_sent, "replies": self.replies, "timeouts": self.timeouts,
+                "errors": list(self.errors.items()), "inflight_max": self.inflight_max,
+                "latency_counts": self.latency_counts, "latency_sum": self.latency_sum}
+
+    def merge(self, state: Dict):
+        """Fold in the counters of another ScanMetrics (e.g. a scan worker's ``state()``)."""
+        self.probes_sent += state["probes_sent"]
+        self.replies += state["replies"]
+        self.timeouts += state["timeouts"]
+        for err, count in state["errors"]:
+            self.errors[err] = self.errors.get(err, 0) + count
+        self.inflight_max = max(self.inflight_max, state["inflight_max"])
+        self.latency_counts = [a + b for a, b in zip(self.latency_counts, state["latency_counts"])]
+        self.latency_sum += state["latency_sum"]
+
+    def merge_worker_usage(self, usage: Dict):
+        """Account a finished scan worker's ``getrusage`` (which RUSAGE_SELF in the parent never sees)."""
+        self.worker_cpu_s += usage["cpu_s"]
+        self.worker_max_rss_kb = max(self.worker_max_rss_kb, usage["max_rss_kb"])
+
+    def observe_reply(self, rtt_ms: float):
+        self.replies += 1
+        self.latency_sum += rtt_ms
+        self.latency_counts[bisect.bisect_left(self.latency_buckets, rtt_ms)] += 1
+
+    def observe_error(self, err: int):
+        self.errors[err] = self.errors.get(err, 0) + 1
+
+    def set_inflight(self, count: int):
+        if count > self.inflight_max:
+            self.inflight_max = count
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        outermost = self._depth == 0
+        self._depth += 1
+        profiler = None
+        if self.profile and outermost:
+            profiler = self._profilers.get(name)
+            if profiler is None:
+                profiler = self._profilers[name] = cProfile.Profile()
+            profiler.enable()
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        elif self.trace_memory:
+            tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            self._depth -= 1
+            stats = self.add_phase(name, wall, cpu)
+            if self.trace_memory:
+                stats["peak_bytes"] = max(stats.get("peak_bytes", 0), tracemalloc.get_traced_memory()[1])
+                if started_tracing:
+                    tracemalloc.stop()
+            if profiler is not None:
+                profiler.disable()
+
+    def add_phase(self, name: str, wall: float, cpu: float) -> Dict[str, float]:
+        """Account one call of a phase timed elsewhere, e.g. a stage running on another thread."""
+        stats = self.phases.setdefault(name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0})
+        stats["calls"] += 1
+        stats["wall_s"] += wall
+        stats["cpu_s"] += cpu
+        return stats
+
+    def dump_profiles(self) -> Dict[str, str]:
+        """Write each phase's accumulated cProfile stats to ``profile_<phase>.pstats``."""
+        if self._profilers:
+            os.makedirs(self.profile_dir, exist_ok=True)
+        for name, profiler in self._profilers.items():
+            path = os.path.join(self.profile_dir, f"profile_{name}.pstats")
+            profiler.dump_stats(path)
+            self.profiles[name] = path
+        return dict(self.profiles)
+
+    def snapshot(self, controller: Optional["AIMDController"] = None) -> Dict:
+        return {
+            "started": self.started, "duration_s": round(time.time() - self.started, 6),
+            "probes_sent": self.probes_sent, "replies": self.replies, "timeouts": self.timeouts,
+            "errors": {errno.errorcode.get(err, str(err)): count for err, count in self.errors.items()},
+            "inflight_max": self.inflight_max,
+            "latency_ms": {
+                "buckets": dict(zip([str(b) for b in self.latency_buckets] + ["+Inf"], self.latency_counts)),
+                "sum": round(self.latency_sum, 3), "count": self.replies
+            },
+            "phases": {name: {k: round(v, 6) if isinstance(v, float) else v for k, v in stats.items()}
+                       for name, stats in self.phases.items()},
+            "profiles": dict(self.profiles),
+            "workers": {"cpu_s": round(self.worker_cpu_s, 6), "max_rss_kb": self.worker_max_rss_kb},
+            "strategy_report": dict(self.strategy_report),
+            "controller": controller.snapshot() if controller is not None else None
+        }
+
+    def to_prometheus(self) -> str:
+        lines = []
+
+        def metric(name: str, kind: str, help_text: str, samples: Iterable[Tuple[str, float]]):
+            lines.append(f"# HELP {METRICS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} {kind}")
+            for suffix, value in samples:
+                lines.append(f"{METRICS_PREFIX}_{suffix} {value!r}")
+
+        phases = sorted(self.phases.items())
+        metric("phase_seconds_total", "counter", "Wall-clock time spent in each scan phase.",
+               [(f'phase_seconds_total{{phase="{n}"}}', s["wall_s"]) for n, s in phases])
+        metric("phase_cpu_seconds_total", "counter", "Process CPU time spent in each scan phase.",
+               [(f'phase_cpu_seconds_total{{phase="{n}"}}', s["cpu_s"]) for n, s in phases])
+        metric("phase_calls_total", "counter", "Times each scan phase was entered.",
+               [(f'phase_calls_total{{phase="{n}"}}', s["calls"]) for n, s in phases])
+        if self.trace_memory:
+            metric("phase_peak_memory_bytes", "gauge", "Peak traced Python allocation per scan phase.",
+                   [(f'phase_peak_memory_bytes{{phase="{n}"}}', s.get("peak_bytes", 0)) for n, s in phases])
+        metric("probes_sent_total", "counter", "UDP probes sent.", [("probes_sent_total", self.probes_sent)])
+        metric("replies_total", "counter", "Probes answered before their timeout.", [("replies_total", self.replies)])
+        metric("timeouts_total", "counter", "Probes that timed out.", [("timeouts_total", self.timeouts)])
+        metric("probe_errors_total", "counter", "Probes that failed to send, by errno.",
+               [(f'probe_errors_total{{errno="{errno.errorcode.get(err, err)}"}}', count)
+                for err, count in sorted(self.errors.items())])
+        metric("inflight_probes_max", "gauge", "Most probes in flight at once.", [("inflight_probes_max", self.inflight_max)])
+        cumulative, buckets = 0, []
+        for bound, count in zip([f"{b:g}" for b in self.latency_buckets] + ["+Inf"], self.latency_counts):
+            cumulative += count
+            buckets.append((f'probe_latency_ms_bucket{{le="{bound}"}}', cumulative))
+        metric("probe_latency_ms", "histogram", "Probe round-trip time in milliseconds.",
+               buckets + [("probe_latency_ms_sum", self.latency_sum), ("probe_latency_ms_count", self.replies)])
+        metric("last_run_timestamp_seconds", "gauge", "Unix time the run started.",
+               [("last_run_timestamp_seconds", self.started)])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        write_atomic(path, self.to_prometheus())
+
+    def write_json(self, path: str, controller: Optional["AIMDController"] = None):
+        write_atomic(path, json.dumps(self.snapshot(controller), indent=2))
+
+# --- Event-driven Scan Engine ---
+class TimerWheel:
+    """Hashed timer wheel: O(1) schedule/cancel, expiry cost proportional to elapsed ticks."""
+
+    def __init__(self, tick: float = ENGINE_TICK, slots: int = ENGINE_WHEEL_SLOTS):
+        self.tick = tick
+        self.slots: List[Dict] = [{} for _ in range(slots)]
+        self.current = int(time.monotonic() / tick)
+
+    def schedule(self, key, deadline: float) -> int:
+        tick_no = max(int(deadline / self.tick), self.current)
+        self.slots[tick_no % len(self.slots)][key] = deadline
+        return tick_no
+
+    def cancel(self, key, tick_no: int):
+        self.slots[tick_no % len(self.slots)].pop(key, None)
+
+    def advance(self, now: float) -> List:
+        # Only fully elapsed ticks are swept; entries belonging to a later
+        # revolution of the wheel stay in their slot.
+        expired = []
+        target = int(now / self.tick)
+        while self.current < target:
+            slot = self.slots[self.current % len(self.slots)]
+            if slot:
+                for key, deadline in list(slot.items()):
+                    if deadline <= now:
+                        del slot[key]
+                        expired.append(key)
+            self.current += 1
+        return expired
+
+
+class UDPScanEngine:
+    """Sends UDP probes from a few non-blocking sockets and matches replies by source (ip, port).
+
+    ``on_probe(ip, port, sent_at, rtt_ms, err)`` is called once per probe: ``rtt_ms`` is None
+    on failure and ``err`` is 0 on success, ``errno.ETIMEDOUT`` on timeout or the send errno.
+    ``payload`` may be a list of prebuilt packets, sent round-robin, or a callable that builds
+    each packet at send time, and a target given as
+    ``(ip, port, payload)`` carries its own packet; ``reply_filter`` rejects datagrams that are
+    not a valid answer to the probe. ``dont_fragment`` sets DF, so oversized probes fail with
+    EMSGSIZE or are dropped on the path instead of being fragmented. A target iterator that has
+    nothing to send yet may yield None; the engine keeps servicing replies and asks again on the
+    next tick. ``stop_when`` is polled once per loop iteration; when it returns True the scan
+    ends at once and probes still in flight are dropped without a callback. When a ``controller`` is
+    attached it supplies the in-flight window, send rate and probe timeout on every loop
+    iteration, and an attached ``metrics`` (ScanMetrics) counts sends, replies, timeouts and errors.
+    """
+
+    def __init__(self, timeout: float = PORT_SCAN_TIMEOUT, max_inflight: int = ENGINE_MAX_INFLIGHT,
+                 payload=b'\x01', sockets_per_family: int = ENGINE_SOCKETS, rate: float = 0.0,
+                 reply_filter: Optional[Callable[[bytes], bool]] = None, controller: Optional["AIMDController"] = None,
+                 metrics: Optional[ScanMetrics] = None, dont_fragment: bool = False,
+                 stop_when: Optional[Callable[[], bool]] = None):
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        self.build_payload = payload if callable(payload) else None
+        self.payloads = [] if callable(payload) else [payload] if isinstance(payload, bytes) else list(payload)
+        self.reply_filter = reply_filter
+        self.sockets_per_family = sockets_per_family
+        self.rate = rate
+        self.controller = controller
+        self.metrics = metrics
+        self.dont_fragment = dont_fragment
+        self.stop_when = stop_when
+
+    def _open_sockets(self, selector, family: int) -> List[socket.socket]:
+        socks = []
+        for _ in range(self.sockets_per_family):
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, ENGINE_RCVBUF)
+            except OSError:
+                pass
+            if self.dont_fragment:
+                if family == socket.AF_INET6:
+                    sock.setsockopt(socket.IPPROTO_IPV6, getattr(socket, "IPV6_MTU_DISCOVER", 23), IP_PMTUDISC_DO)
+                else:
+                    sock.setsockopt(socket.IPPROTO_IP, getattr(socket, "IP_MTU_DISCOVER", 10), IP_PMTUDISC_DO)
+            selector.register(sock, selectors.EVENT_READ)
+            socks.append(sock)
+        return socks
+
+    def scan(self, targets: Iterable[Tuple[str, int]], on_probe: Callable) -> int:
+        selector = selectors.DefaultSelector()
+        sockets: Dict[int, List[socket.socket]] = {}
+        inflight: Dict[Tuple[str, int], Tuple[float, int]] = {}
+        deferred = deque()
+        wheel = TimerWheel()
+        targets = iter(targets)
+        exhausted = False
+        sent = rr = 0
+        payloads, reply_filter, controller, metrics = self.payloads, self.reply_filter, self.controller, self.metrics
+        build_payload = self.build_payload
+        stop_when = self.stop_when
+        max_inflight, rate, timeout = self.max_inflight, self.rate, self.timeout
+        tokens, last_refill = 1.0, time.monotonic()
+        if controller is not None:
+            controller.begin_scan(last_refill)
+        try:
+            while True:
+                now = time.monotonic()
+                if controller is not None:
+                    controller.tick(now)
+                    max_inflight, rate, timeout = controller.window, controller.rate, controller.timeout
+                if rate:
+                    tokens = min(tokens + (now - last_refill) * rate, max(1.0, rate * ENGINE_TICK))
+                    last_refill = now
+                while len(inflight) < max_inflight and (not rate or tokens >= 1.0):
+                    if deferred:
+                        target = deferred.popleft()
+                    elif exhausted:
+                        break
+                    else:
+                        try:
+                            target = next(targets)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        if target is None:
+                            break
+                    ip, port = target[0], target[1]
+                    family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+                    if family == socket.AF_INET6:
+                        # Normalise so the key matches the address recvfrom() reports.
+                        ip = socket.inet_ntop(family, socket.inet_pton(family, ip))
+                    key = (ip, port)
+                    if key in inflight:
+                        deferred.append(target)
+                        break
+                    socks = sockets.get(family)
+                    if socks is None:
+                        socks = sockets[family] = self._open_sockets(selector, family)
+                    rr += 1
+                    try:
+                        if len(target) > 2:
+                            packet = target[2]
+                        else:
+                            packet = build_payload() if build_payload is not None else payloads[rr % len(payloads)]
+                        socks[rr % len(socks)].sendto(packet, key)
+                    except BlockingIOError:
+                        deferred.appendleft(target)
+                        break
+                    except OSError as e:
+                        if metrics is not None:
+                            metrics.observe_error(e.errno or errno.EIO)
+                        on_probe(ip, port, now, None, e.errno or errno.EIO)
+                        continue
+                    inflight[key] = (now, wheel.schedule(key, now + timeout))
+                    sent += 1
+                    tokens -= 1.0
+                if metrics is not None:
+                    metrics.set_inflight(len(inflight))
+                if (exhausted and not inflight and not deferred) or (stop_when is not None and stop_when()):
+                    break
+                if sockets:
+                    events = selector.select(ENGINE_TICK)
+                else:
+                    events = []
+                    time.sleep(ENGINE_TICK)
+                # One timestamp per wakeup: every datagram drained below arrived before it.
+                received = time.monotonic()
+                for sel_key, _ in events:
+                    sock = sel_key.fileobj
+                    while True:
+                        try:
+                            data, addr = sock.recvfrom(ENGINE_RECV_SIZE)
+                        except BlockingIOError:
+                            break
+                        except OSError:
+                            continue
+                        key = (addr[0], addr[1])
+                        if key not in inflight or (reply_filter is not None and not reply_filter(data)):
+                            continue
+                        entry = inflight.pop(key)
+                        wheel.cancel(key, entry[1])
+                        rtt = (received - entry[0]) * 1000
+                        if controller is not None:
+                            controller.on_reply(rtt)
+                        if metrics is not None:
+                            metrics.observe_reply(rtt)
+                        on_probe(key[0], key[1], entry[0], rtt, 0)
+                for key in wheel.advance(received):
+                    entry = inflight.pop(key, None)
+                    if entry is not None:
+                        if controller is not None:
+                            controller.on_timeout()
+                        if metrics is not None:
+                            metrics.timeouts += 1
+                        on_probe(key[0], key[1], entry[0], None, errno.ETIMEDOUT)
+        finally:
+            for socks in sockets.values():
+                for sock in socks:
+                    selector.unregister(sock)
+                    sock.close()
+            selector.close()
+            if metrics is not None:
+                metrics.probes_sent += sent
+        return sent
+
+# --- Adaptive Rate Control ---
+class AIMDController:
+    """Additive-increase/multiplicative-decrease control of in-flight probes and packets/sec.
+
+    Every ``interval`` seconds the controller compares the reply ratio and median RTT of the last
+    interval with baselines learned from uncongested intervals of the current scan. Scans mix
+    near and far, live and dead targets, so baselines are reset by ``begin_scan`` and only learned
+    once a full probe timeout has elapsed; a reply drop must exceed ``loss_tolerance`` and the
+    binomial noise of the interval, and RTT inflation beyond ``rtt_inflation`` needs a few ms of
+    slack on top. Either counts as congestion and shrinks window and rate by ``decrease``;
+    otherwise both grow additively. Probe timeouts follow the observed RTT distribution
+    (Jacobson/Karels SRTT and a high percentile of recent samples); ``initial_timeout`` seeds
+    the timeout until enough samples arrive. Each decision is kept in ``decisions``.
+    """
+
+    def __init__(self, initial_rtt: Optional[float] = None, min_inflight: int = 16, max_inflight: int = 4096,
+                 initial_inflight: int = 1024, min_rate: float = 50, max_rate: float = 50000, initial_rate: float = 2000,
+                 increase_inflight: int = 64, increase_rate: float = 200, decrease: float = 0.5, interval: float = 0.25,
+                 loss_tolerance: float = 0.2, rtt_inflation: float = 2.0, min_timeout: float = 0.25,
+                 max_timeout: float = 4.0, min_replies: int = 20, log_path: Optional[str] = None,
+                 initial_timeout: Optional[float] = None):
+        self.min_inflight, self.max_inflight = min_inflight, max_inflight
+        self.min_rate, self.max_rate = min_rate, max_rate
+        self.increase_inflight, self.increase_rate = increase_inflight, increase_rate
+        self.decrease, self.interval = decrease, interval
+        self.loss_tolerance, self.rtt_inflation = loss_tolerance, rtt_inflation
+        self.min_timeout, self.max_timeout = min_timeout, max_timeout
+        self.min_replies = min_replies
+        self.window = initial_inflight
+        self.rate = float(initial_rate)
+        self.srtt = initial_rtt
+        self.rttvar = initial_rtt / 2 if initial_rtt else None
+        self.timeout = initial_timeout if initial_timeout is not None else self._derive_timeout(None)
+        self.samples = array('f', bytes(4 * CONTROLLER_RTT_WINDOW))
+        self.sample_count = 0
+        self.decisions = deque(maxlen=CONTROLLER_DECISION_LOG)
+        self.log_path = log_path
+        self.begin_scan()
+
+    def begin_scan(self, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        self.baseline_ratio: Optional[float] = None
+        self.baseline_rtt: Optional[float] = None
+        self.replies = self.timeouts = 0
+        self.interval_rtts: List[float] = []
+        self.next_tick = now + self.interval
+        # Until one timeout has passed, intervals only contain replies and would inflate the baseline.
+        self.learn_after = now + self.timeout
+
+    def on_reply(self, rtt: float):
+        self.replies += 1
+        self.samples[self.sample_count % CONTROLLER_RTT_WINDOW] = rtt
+        self.sample_count += 1
+        self.interval_rtts.append(rtt)
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def on_timeout(self):
+        self.timeouts += 1
+
+    def _derive_timeout(self, tail: Optional[float]) -> float:
+        if self.srtt is None:
+            return self.max_timeout / 2
+        estimate = max(self.srtt + 4 * self.rttvar, (tail or 0) * 2)
+        return min(max(estimate / 1000, self.min_timeout), self.max_timeout)
+
+    def tick(self, now: float):
+        if now < self.next_tick:
+            return
+        self.next_tick = now + self.interval
+        total = self.replies + self.timeouts
+        if not total:
+            return
+        ratio = self.replies / total
+        median = sorted(self.interval_rtts)[len(self.interval_rtts) // 2] if self.interval_rtts else None
+        rtt_inflated = (median is not None and self.baseline_rtt is not None and self.replies >= self.min_replies
+                        and median > self.baseline_rtt * self.rtt_inflation + CONTROLLER_RTT_SLACK_MS)
+        expected = (self.baseline_ratio or 0) * total
+        replies_dropped = (expected >= self.min_replies
+                           and self.replies < expected * (1 - self.loss_tolerance) - 2 * math.sqrt(expected))
+        if rtt_inflated or replies_dropped:
+            action = "decrease"
+            self.window = max(self.min_inflight, int(self.window * self.decrease))
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+        else:
+            action = "increase"
+            self.window = min(self.max_inflight, self.window + self.increase_inflight)
+            self.rate = min(self.max_rate, self.rate + self.increase_rate)
+            if now >= self.learn_after and total >= self.min_replies:
+                if self.baseline_ratio is None:
+                    self.baseline_ratio = ratio
+                else:
+                    # Rise quickly, sink slowly: sustained mild loss must not become the new normal.
+                    weight = 0.2 if ratio > self.baseline_ratio else 0.02
+                    self.baseline_ratio += weight * (ratio - self.baseline_ratio)
+            if median is not None and self.replies >= self.min_replies:
+                self.baseline_rtt = median if self.baseline_rtt is None else 0.8 * self.baseline_rtt + 0.2 * median
+        filled = min(self.sample_count, CONTROLLER_RTT_WINDOW)
+        if filled >= CONTROLLER_MIN_TAIL_SAMPLES:
+            self.timeout = self._derive_timeout(sorted(self.samples[:filled])[int(filled * 0.99) - 1])
+        decision = {
+            "time": round(time.time(), 3), "action": action, "replies": self.replies, "timeouts": self.timeouts,
+            "reply_ratio": round(ratio, 4), "baseline_ratio": round(self.baseline_ratio or 0, 4),
+            "median_rtt": round(median, 2) if median is not None else None,
+            "baseline_rtt": round(self.baseline_rtt, 2) if self.baseline_rtt is not None else None,
+            "window": self.window, "rate": round(self.rate, 1), "timeout": round(self.timeout, 3)
+        }
+        self.decisions.append(decision)
+        if self.log_path:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(decision) + "\n")
+        self.replies = self.timeouts = 0
+        self.interval_rtts = []
+
+    def state(self) -> Dict:
+        """RTT estimate and recent samples, for ``merge`` into another controller (e.g. from a scan worker)."""
+        filled = min(self.sample_count, CONTROLLER_RTT_WINDOW)
+        return {"srtt": self.srtt, "rttvar": self.rttvar, "timeout": self.timeout, "sample_count": self.sample_count,
+                "samples": [round(rtt, 3) for rtt in self.samples[:filled]]}
+
+    def merge(self, state: Dict):
+        """Fold in another controller's ``state()``: SRTT/RTTVAR weighted by sample count, samples
+        appended to the tail window, and the more cautious of the two trained timeouts."""
+        if state["srtt"] is None or not state["sample_count"]:
+            return
+        if self.srtt is None or not self.sample_count:
+            self.srtt, self.rttvar, self.timeout = state["srtt"], state["rttvar"], state["timeout"]
+        else:
+            weight = state["sample_count"] / (self.sample_count + state["sample_count"])
+            self.srtt += weight * (state["srtt"] - self.srtt)
+            self.rttvar += weight * (state["rttvar"] - self.rttvar)
+            self.timeout = max(self.timeout, state["timeout"])
+        for rtt in state["samples"]:
+            self.samples[self.sample_count % CONTROLLER_RTT_WINDOW] = rtt
+            self.sample_count += 1
+
+    def snapshot(self, decisions: bool = True) -> Dict:
+        """Current window, rate and RTT estimates; the decision log, or with ``decisions=False`` its length."""
+        return {"window": self.window, "rate": self.rate, "timeout": self.timeout, "srtt": self.srtt,
+                "rttvar": self.rttvar, "baseline_rtt": self.baseline_rtt, "baseline_ratio": self.baseline_ratio,
+                "decisions": list(self.decisions) if decisions else len(self.decisions)}
+
+# --- WireGuard Handshake Probe ---
+def _wg_hash(*parts: bytes) -> bytes:
+    h = hashlib.blake2s()
+    for part in parts:
+        h.update(part)
+    return h.digest()
+
+def _wg_mac(key: bytes, data: bytes) -> bytes:
+    return hashlib.blake2s(data, digest_size=16, key=key).digest()
+
+def _wg_hmac(key: bytes, data: bytes) -> bytes:
+    return hmac.new(key, data, hashlib.blake2s).digest()
+
+def _wg_kdf(key: bytes, data: bytes, n: int) -> List[bytes]:
+    prk = _wg_hmac(key, data)
+    out, prev = [], b""
+    for i in range(1, n + 1):
+        prev = _wg_hmac(prk, prev + bytes([i]))
+        out.append(prev)
+    return out
+
+def _wg_aead(key: bytes, plaintext: bytes, ad: bytes) -> bytes:
+    return aead.ChaCha20Poly1305(key).encrypt(b"\x00" * 12, plaintext, ad)
+
+def _wg_open(key: bytes, ciphertext: bytes, ad: bytes) -> bytes:
+    return aead.ChaCha20Poly1305(key).decrypt(b"\x00" * 12, ciphertext, ad)
+
+def _wg_dh(private: "x25519.X25519PrivateKey", public: bytes) -> bytes:
+    return private.exchange(x25519.X25519PublicKey.from_public_bytes(public))
+
+def _wg_public(private: "x25519.X25519PrivateKey") -> bytes:
+    return private.public_key().public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+
+def _wg_tai64n(nanoseconds: int) -> bytes:
+    seconds, nanos = divmod(nanoseconds, 1_000_000_000)
+    return struct.pack(">QI", 0x400000000000000a + seconds, nanos)
+
+def _wg_initial_state(responder_public: bytes) -> Tuple[bytes, bytes]:
+    chaining_key = _wg_hash(WG_CONSTRUCTION)
+    return chaining_key, _wg_hash(_wg_hash(chaining_key, WG_IDENTIFIER), responder_public)
+
+
+class WireGuardProbe:
+    """WireGuard handshake initiations for one WarpKey.
+
+    A responder drops any initiation whose timestamp is not newer than the last one it accepted
+    from our static key, so packets cannot simply be replayed. The expensive part (ephemeral key,
+    both DHs, encrypted static) is done once per pool slot in ``__init__``; ``build_initiation``
+    then only encrypts a fresh, strictly increasing timestamp and computes mac1. Replies are
+    checked to be handshake responses addressed to one of our sender indices with a valid mac1.
+    """
+
+    def __init__(self, warp_key: WarpKey, pool_size: int = WG_PROBE_POOL):
+        self.static_private = x25519.X25519PrivateKey.from_private_bytes(base64.b64decode(warp_key.private_key))
+        self.static_public = _wg_public(self.static_private)
+        self.peer_public = base64.b64decode(warp_key.public_key)
+        self.reserved = base64.b64decode(warp_key.client_id)[:3].ljust(3, b"\x00") if warp_key.client_id else b"\x00\x00\x00"
+        self.reply_mac_key = _wg_hash(WG_LABEL_MAC1, self.static_public)
+        self.mac1_key = _wg_hash(WG_LABEL_MAC1, self.peer_public)
+        self.slots = [self._prepare() for _ in range(pool_size)]
+        self.sender_indices = {prefix[4:8] for prefix, _, _ in self.slots}
+        self.sent = 0
+        self._last_timestamp = 0
+
+    def _prepare(self) -> Tuple[bytes, bytes, bytes]:
+        """Message prefix up to the encrypted static, plus the hash and key that seal the timestamp."""
+        chaining_key, h = _wg_initial_state(self.peer_public)
+        ephemeral = x25519.X25519PrivateKey.generate()
+        ephemeral_public = _wg_public(ephemeral)
+        chaining_key = _wg_kdf(chaining_key, ephemeral_public, 1)[0]
+        h = _wg_hash(h, ephemeral_public)
+        chaining_key, key = _wg_kdf(chaining_key, _wg_dh(ephemeral, self.peer_public), 2)
+        encrypted_static = _wg_aead(key, self.static_public, h)
+        h = _wg_hash(h, encrypted_static)
+        chaining_key, key = _wg_kdf(chaining_key, _wg_dh(self.static_private, self.peer_public), 2)
+        prefix = struct.pack("<B3x", WG_MSG_INITIATION) + os.urandom(4) + ephemeral_public + encrypted_static
+        return prefix, h, key
+
+    def build_initiation(self) -> bytes:
+        prefix, h, key = self.slots[self.sent % len(self.slots)]
+        self.sent += 1
+        self._last_timestamp = max(time.time_ns(), self._last_timestamp + 1)
+        body = prefix + _wg_aead(key, _wg_tai64n(self._last_timestamp), h)
+        mac1 = _wg_mac(self.mac1_key, body)
+        # WARP routes on the reserved header bytes; they are set after the MACs, as the
+        # official clients do, and zeroed again by the receiver before verification.
+        packet = bytearray(body + mac1 + b"\x00" * 16)
+        packet[1:4] = self.reserved
+        return bytes(packet)
+
+    def is_response(self, data: bytes) -> bool:
+        if len(data) != WG_RESPONSE_SIZE or data[0] != WG_MSG_RESPONSE or data[8:12] not in self.sender_indices:
+            return False
+        return hmac.compare_digest(_wg_mac(self.reply_mac_key, b"\x02\x00\x00\x00" + data[4:60]), data[60:76])
+
+
+class WireGuardResponder:
+    """Local peer that answers handshake initiations, for testing the probe offline.
+
+    Like a real peer it keeps the newest timestamp accepted per initiator static key and drops
+    replayed or older initiations. With ``host=None`` no socket is opened and ``respond`` is
+    used directly (the simulated farm does this).
+    """
+
+    def __init__(self, private_key: Optional[bytes] = None, host: Optional[str] = "127.0.0.1", port: int = 0):
+        self.static_private = (x25519.X25519PrivateKey.from_private_bytes(private_key) if private_key
+                               else x25519.X25519PrivateKey.generate())
+        self.public_key = _wg_public(self.static_private)
+        self.mac1_key = _wg_hash(WG_LABEL_MAC1, self.public_key)
+        self.sock: Optional[socket.socket] = None
+        self.address: Optional[Tuple[str, int]] = None
+        if host is not None:
+            family = socket.AF_INET6 if ':' in host else socket.AF_INET
+            self.sock = socket.socket(family, socket.SOCK_DGRAM)
+            self.sock.bind((host, port))
+            self.address = self.sock.getsockname()[:2]
+        self.latest_timestamp: Dict[bytes, bytes] = {}
+        self.handshakes = self.replays = 0
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    def respond(self, packet: bytes) -> Optional[bytes]:
+        if len(packet) != WG_INITIATION_SIZE or packet[0] != WG_MSG_INITIATION:
+            return None
+        body = b"\x01\x00\x00\x00" + packet[4:116]
+        if not hmac.compare_digest(_wg_mac(self.mac1_key, body), packet[116:132]):
+            return None
+        sender, ephemeral_i = packet[4:8], packet[8:40]
+        try:
+            chaining_key, h = _wg_initial_state(self.public_key)
+            chaining_key = _wg_kdf(chaining_key, ephemeral_i, 1)[0]
+            h = _wg_hash(h, ephemeral_i)
+            chaining_key, key = _wg_kdf(chaining_key, _wg_dh(self.static_private, ephemeral_i), 2)
+            static_i = _wg_open(key, packet[40:88], h)
+            h = _wg_hash(h, packet[40:88])
+            chaining_key, key = _wg_kdf(chaining_key, _wg_dh(self.static_private, static_i), 2)
+            timestamp = _wg_open(key, packet[88:116], h)
+            h = _wg_hash(h, packet[88:116])
+        except Exception:
+            return None
+        # TAI64N is big-endian, so byte order is time order.
+        if timestamp <= self.latest_timestamp.get(static_i, b""):
+            self.replays += 1
+            return None
+        self.latest_timestamp[static_i] = timestamp
+        ephemeral = x25519.X25519PrivateKey.generate()
+        ephemeral_public = _wg_public(ephemeral)
+        chaining_key = _wg_kdf(chaining_key, ephemeral_public, 1)[0]
+        h = _wg_hash(h, ephemeral_public)
+        chaining_key = _wg_kdf(chaining_key, _wg_dh(ephemeral, ephemeral_i), 1)[0]
+        chaining_key = _wg_kdf(chaining_key, _wg_dh(ephemeral, static_i), 1)[0]
+        chaining_key, tau, key = _wg_kdf(chaining_key, b"\x00" * 32, 3)
+        h = _wg_hash(h, tau)
+        empty = _wg_aead(key, b"", h)
+        body = struct.pack("<B3x", WG_MSG_RESPONSE) + os.urandom(4) + sender + ephemeral_public + empty
+        self.handshakes += 1
+        return body + _wg_mac(_wg_hash(WG_LABEL_MAC1, static_i), body) + b"\x00" * 16
+
+    def serve_forever(self):
+        self._running = True
+        self.sock.settimeout(0.2)
+        while self._running:
+            try:
+                packet, addr = self.sock.recvfrom(ENGINE_RECV_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            reply = self.respond(packet)
+            if reply:
+                self.sock.sendto(reply, addr)
+
+    def start(self) -> "WireGuardResponder":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+        self.sock.close()
+
+# --- Range Target Space ---
+def score_endpoint(latency: float, packet_loss: float, jitter: float, weights: Tuple[float, float, float] = SCORE_WEIGHTS) -> float:
+    return max(0, (1000 - latency) * weights[0] + (100 - packet_loss) * weights[1] + (10 - jitter) * weights[2])
+
+def score_arrays(latency, packet_loss, jitter, weights: Tuple[float, float, float] = SCORE_WEIGHTS):
+    return np.maximum(0, (1000 - latency) * weights[0] + (100 - packet_loss) * weights[1] + (10 - jitter) * weights[2])
+
+def probe_stats(samples, percentile: float = 90) -> Dict[str, "np.ndarray"]:
+    """Per-row statistics of a (candidates × samples) RTT matrix where NaN marks a lost probe.
+
+    Rows with no replies get infinite latency and 100% loss. Jitter is the mean absolute
+    difference between consecutive received samples (RFC 3550 style, unsmoothed).
+    """
+    valid = ~np.isnan(samples)
+    received = valid.sum(axis=1)
+    alive = received > 0
+    loss = 100.0 * (1.0 - received / samples.shape[1])
+    mean = np.where(valid, samples, 0).sum(axis=1, dtype=np.float64) / np.maximum(received, 1)
+    ordered = np.sort(samples, axis=1)  # NaNs sort last
+    rank = np.clip(np.ceil(percentile / 100.0 * received).astype(np.int64) - 1, 0, samples.shape[1] - 1)
+    tail = np.take_along_axis(ordered, rank[:, None], axis=1)[:, 0].astype(np.float64)
+    pairs = valid[:, 1:] & valid[:, :-1]
+    deltas = np.where(pairs, np.abs(np.diff(samples, axis=1)), 0).sum(axis=1, dtype=np.float64)
+    jitter = deltas / np.maximum(pairs.sum(axis=1), 1)
+    return {
+        "mean": np.where(alive, mean, np.inf),
+        "percentile": np.where(alive, tail, np.inf),
+        "jitter": jitter,
+        "loss": loss,
+        "received": received
+    }
+
+
+class SuccessiveHalving:
+    """Spend measurement probes on the leaders instead of on every candidate equally.
+
+    Round ``r`` tops every surviving candidate up to ``initial_samples * 2**r`` samples and keeps
+    the best-scoring ``1/eta`` of them (never fewer than ``keep_factor * top_k``).
+    It stops once the ordered top-k is unchanged for ``stable_rounds`` rounds with only the keep
+    floor left, or when survivors reach ``max_samples``. Survivors end with the same sample
+    count, so their final statistics are directly comparable.
+    """
+
+    def __init__(self, top_k: int, max_samples: int, eta: float = 2.0, initial_samples: int = 1,
+                 keep_factor: int = 2, stable_rounds: int = 2):
+        self.top_k = top_k
+        self.max_samples = max_samples
+        self.eta = eta
+        self.initial_samples = initial_samples
+        self.keep_floor = keep_factor * top_k
+        self.stable_rounds = stable_rounds
+        self.report: Dict = {}
+
+    def run(self, candidates: List[Tuple[str, int]], measure: Callable, score: Callable):
+        matrix = np.full((len(candidates), self.max_samples), np.nan, dtype=np.float32)
+        active = np.arange(len(candidates))
+        filled, probes, rounds, stable = 0, 0, 0, 0
+        leaders = None
+        while True:
+            target = min(self.max_samples, self.initial_samples << rounds)
+            matrix[active, filled:target] = measure([candidates[i] for i in active], target - filled)
+            probes += len(active) * (target - filled)
+            filled = target
+            rounds += 1
+            scores = score(matrix[active, :filled])
+            order = np.argsort(-scores, kind="stable")
+            current = tuple(active[order[:self.top_k]])
+            stable = stable + 1 if current == leaders else 0
+            leaders = current
+            keep = max(self.keep_floor, int(np.ceil(len(order) / self.eta)))
+            active = active[order[:keep]]
+            if filled >= self.max_samples or (stable >= self.stable_rounds and len(active) <= self.keep_floor):
+                break
+        exhaustive = len(candidates) * self.max_samples
+        self.report = {
+            "candidates": len(candidates), "rounds": rounds, "probes": probes, "exhaustive_probes": exhaustive,
+            "probes_saved": exhaustive - probes, "samples_per_survivor": filled, "survivors": len(active)
+        }
+        return active, matrix[active, :filled]
+
+
+class TargetSpace:
+    """(ip, port) targets over IPv4 CIDR ranges, stored as integer intervals.
+
+    Iteration walks a keyed Feistel permutation of ``[0, len(self))`` with cycle-walking, so
+    targets come out shuffled without ever materialising the list; memory is O(#ranges).
+    """
+
+    def __init__(self, ranges: Iterable[str], ports: Iterable[int] = WARP_PORTS, seed: Optional[int] = None):
+        intervals = []
+        for cidr in ranges:
+            network = ipaddress.ip_network(cidr, strict=False)
+            if network.version != 4:
+                raise ValueError(f"Range scanning supports IPv4 CIDRs only: {cidr}")
+            intervals.append((int(network.network_address), network.num_addresses))
+        self.starts = array('L')
+        self.offsets = array('Q', [0])
+        for start, size in sorted(intervals):
+            last_end = self.starts[-1] + self.offsets[-1] - self.offsets[-2] if self.starts else -1
+            if start < last_end:
+                # Overlapping CIDRs are merged so no target is produced twice.
+                self.offsets[-1] = self.offsets[-2] + max(start + size, last_end) - self.starts[-1]
+                continue
+            self.starts.append(start)
+            self.offsets.append(self.offsets[-1] + size)
+        self.ports = array('H', ports)
+        self.addresses = self.offsets[-1]
+        self.size = self.addresses * len(self.ports)
+        self.half_bits = max(1, ((self.size - 1).bit_length() + 1) // 2)
+        rng = random.Random(seed)
+        self.round_keys = [rng.getrandbits(32) | 1 for _ in range(TARGET_FEISTEL_ROUNDS)]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _permute(self, index: int) -> int:
+        bits, mask = self.half_bits, (1 << self.half_bits) - 1
+        while True:
+            left, right = index >> bits, index & mask
+            for key in self.round_keys:
+                left, right = right, left ^ ((((right * key) ^ (right >> 3)) + key) & mask)
+            index = (left << bits) | right
+            if index < self.size:
+                return index
+
+    def target(self, index: int) -> Tuple[str, int]:
+        address, port_index = divmod(index, len(self.ports))
+        interval = bisect.bisect_right(self.offsets, address) - 1
+        ip_int = self.starts[interval] + address - self.offsets[interval]
+        return socket.inet_ntoa(struct.pack("!I", ip_int)), self.ports[port_index]
+
+    def contains(self, ip: str, port: int) -> bool:
+        if port not in self.ports or ':' in ip:
+            return False
+        ip_int = struct.unpack("!I", socket.inet_aton(ip))[0]
+        interval = bisect.bisect_right(self.starts, ip_int) - 1
+        return interval >= 0 and ip_int - self.starts[interval] < self.offsets[interval + 1] - self.offsets[interval]
+
+    def index(self, ip: str, port: int) -> Optional[int]:
+        """Position of a target before permutation, or None when it is outside the space."""
+        if not self.contains(ip, port):
+            return None
+        ip_int = struct.unpack("!I", socket.inet_aton(ip))[0]
+        interval = bisect.bisect_right(self.starts, ip_int) - 1
+        address = self.offsets[interval] + ip_int - self.starts[interval]
+        return address * len(self.ports) + self.ports.index(port)
+
+    def bitmap(self, targets: Iterable[Tuple[str, int]]) -> bytearray:
+        """One bit per target in the space, set for each of ``targets`` that falls inside it."""
+        bits = bytearray((self.size + 7) >> 3)
+        for ip, port in targets:
+            index = self.index(ip, port)
+            if index is not None:
+                bits[index >> 3] |= 1 << (index & 7)
+        return bits
+
+    def __iter__(self):
+        return self.iter_shard(0, 1)
+
+    def iter_shard(self, shard: int, shards: int, skip: Optional[bytearray] = None):
+        for position in range(shard, self.size, shards):
+            index = self._permute(position)
+            if skip is None or not skip[index >> 3] >> (index & 7) & 1:
+                yield self.target(index)
+
+
+class TopK:
+    """Bounded min-heap keeping the ``k`` highest-scoring items seen so far."""
+
+    def __init__(self, k: int):
+        self.k = k
+        self.heap: List[Tuple[float, int, object]] = []
+        self.pushed = 0
+
+    def push(self, score: float, item) -> bool:
+        self.pushed += 1
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, (score, self.pushed, item))
+            return True
+        if score > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (score, self.pushed, item))
+            return True
+        return False
+
+    def items(self) -> List:
+        return [item for _, _, item in sorted(self.heap, key=lambda entry: (-entry[0], entry[1]))]
+
+    def threshold(self) -> float:
+        return self.heap[0][0] if len(self.heap) >= self.k else -math.inf
+
+
+class Candidate:
+    """One reply kept for ranking; a slotted record instead of a ScanResult per probe."""
+
+    __slots__ = ("ip", "port", "latency", "score")
+
+    def __init__(self, ip: str, port: int, latency: float, score: float):
+        self.ip, self.port, self.latency, self.score = ip, port, latency, score
+
+    def result(self) -> ScanResult:
+        return ScanResult(ip=self.ip, port=self.port, latency=self.latency, packet_loss=0.0, jitter=0.0, score=self.score)
+
+
+class LiveRanking:
+    """Streaming ranking of probe replies: a bounded heap of ``k`` candidates plus the current
+    ``leaders`` (top ``display_n``), whose last change time drives the stable-top early exit.
+    Replies that cannot enter the heap cost one score and one comparison.
+    """
+
+    def __init__(self, k: int, weights: Tuple[float, float, float] = SCORE_WEIGHTS, display_n: int = 10,
+                 stable_for: float = 0.0):
+        self.top = TopK(k)
+        self.leaders = TopK(min(k, display_n))
+        self.weights = weights
+        self.stable_for = stable_for
+        self.changed_at = time.monotonic()
+        self.settled_at: Optional[float] = None
+        self.replies = 0
+
+    def add(self, ip: str, port: int, rtt: float) -> Optional[Candidate]:
+        self.replies += 1
+        score = score_endpoint(rtt, 0.0, 0.0, self.weights)
+        if score <= self.top.threshold():
+            return None
+        candidate = Candidate(ip, port, rtt, score)
+        self.top.push(score, candidate)
+        if self.leaders.push(score, candidate):
+            self.changed_at = time.monotonic()
+        return candidate
+
+    def stable(self) -> bool:
+        """True once the leaders have been unchanged for ``stable_for`` seconds; latched in ``settled_at``."""
+        now = time.monotonic()
+        if (self.stable_for > 0 and len(self.leaders.heap) >= self.leaders.k
+                and now - self.changed_at >= self.stable_for):
+            self.settled_at = self.settled_at or now
+            return True
+        return False
+
+    def candidates(self) -> List[Candidate]:
+        return self.top.items()
+
+    def leading(self) -> List[Candidate]:
+        return self.leaders.items()
+
+# --- IPv6 Sampling ---
+class IPv6Sampler:
+    """Stratified IPv6 address sampling with coverage that persists across runs.
+
+    Every prefix is split into ``/stratum`` subnets. A run spends ``explore`` of its budget on one
+    address in each of a random selection of never-probed strata (round-robin across prefixes),
+    and the rest on the neighbourhood of addresses that answered before: adjacent addresses
+    first, then random hosts in responsive strata. Probed and responsive strata are kept as two
+    bitmaps per prefix, probed addresses in a Bloom filter, and responders in a short list, all
+    in one binary file that is rewritten atomically after each run.
+    """
+
+    def __init__(self, prefixes: Iterable[str] = WARP_V6_PREFIXES, stratum: int = 112, path: Optional[str] = V6_COVERAGE_FILE,
+                 bloom_bits: int = 1 << 20, bloom_hashes: int = 4, seed: Optional[int] = None):
+        self.networks = [ipaddress.IPv6Network(p, strict=False) for p in prefixes]
+        self.stratum = stratum
+        for network in self.networks:
+            if not network.prefixlen <= stratum <= 128 or stratum - network.prefixlen > V6_MAX_STRATA_BITS:
+                raise ValueError(f"/{stratum} strata do not fit {network} (at most 2^{V6_MAX_STRATA_BITS} strata per prefix)")
+        self.strata = [1 << (stratum - n.prefixlen) for n in self.networks]
+        self.bloom_bits = 1 << max(3, (bloom_bits - 1).bit_length())
+        self.bloom_hashes = bloom_hashes
+        self.path = path
+        self.rng = random.Random(seed)
+        self.runs = 0
+        self.reset()
+        if path and os.path.exists(path):
+            self.load()
+
+    def reset(self):
+        self.probed = [bytearray((n + 7) // 8) for n in self.strata]
+        self.alive = [bytearray((n + 7) // 8) for n in self.strata]
+        self.bloom = bytearray(self.bloom_bits // 8)
+        self.responsive: List[int] = []
+
+    def _header(self) -> Dict:
+        return {"prefixes": [str(n) for n in self.networks], "stratum": self.stratum,
+                "bloom_bits": self.bloom_bits, "bloom_hashes": self.bloom_hashes}
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        try:
+            if data[:4] != V6_COVERAGE_MAGIC:
+                raise ValueError("bad magic")
+            (header_len,) = struct.unpack_from("!I", data, 4)
+            header = json.loads(data[8:8 + header_len])
+            if {k: header.get(k) for k in self._header()} != self._header():
+                return  # prefixes or layout changed: start over rather than misread old coverage
+            view, offset = memoryview(data), 8 + header_len
+            for i, size in enumerate(len(b) for b in self.probed):
+                self.probed[i][:] = view[offset:offset + size]
+                self.alive[i][:] = view[offset + size:offset + 2 * size]
+                offset += 2 * size
+            self.bloom[:] = view[offset:offset + len(self.bloom)]
+            offset += len(self.bloom)
+            self.responsive = [int.from_bytes(view[o:o + 16], "big") for o in range(offset, offset + 16 * header["responsive"], 16)]
+            self.runs = header.get("runs", 0)
+        except (ValueError, KeyError, struct.error):
+            self.reset()
+
+    def save(self):
+        if not self.path:
+            return
+        header = json.dumps({**self._header(), "responsive": len(self.responsive), "runs": self.runs}).encode()
+        parts = [V6_COVERAGE_MAGIC, struct.pack("!I", len(header)), header]
+        for probed, alive in zip(self.probed, self.alive):
+            parts += [bytes(probed), bytes(alive)]
+        parts.append(bytes(self.bloom))
+        parts += [addr.to_bytes(16, "big") for addr in self.responsive]
+        write_atomic(self.path, b"".join(parts))
+
+    def _bloom_positions(self, addr: int) -> List[int]:
+        digest = hashlib.blake2b(addr.to_bytes(16, "big"), digest_size=4 * self.bloom_hashes).digest()
+        mask = self.bloom_bits - 1
+        return [int.from_bytes(digest[i:i + 4], "big") & mask for i in range(0, len(digest), 4)]
+
+    def seen(self, addr: int) -> bool:
+        return all(self.bloom[p >> 3] >> (p & 7) & 1 for p in self._bloom_positions(addr))
+
+    def _locate(self, addr: int) -> Optional[Tuple[int, int]]:
+        for i, network in enumerate(self.networks):
+            offset = addr - int(network.network_address)
+            if 0 <= offset < network.num_addresses:
+                return i, offset >> (128 - self.stratum)
+        return None
+
+    @staticmethod
+    def _bit(bitmap: bytearray, index: int) -> bool:
+        return bool(bitmap[index >> 3] >> (index & 7) & 1)
+
+    def _host(self, prefix: int, stratum: int) -> int:
+        host_bits = 128 - self.stratum
+        return int(self.networks[prefix].network_address) + (stratum << host_bits) + self.rng.getrandbits(host_bits)
+
+    def _unprobed(self, prefix: int, want: int) -> List[int]:
+        bitmap, total = self.probed[prefix], self.strata[prefix]
+        # Random probing is cheap while coverage is sparse; fall back to a full bitmap scan once it is not.
+        picks = set()
+        for _ in range(want * 4):
+            index = self.rng.randrange(total)
+            if not self._bit(bitmap, index):
+                picks.add(index)
+                if len(picks) == want:
+                    return list(picks)
+        free = [i for i in range(total) if not self._bit(bitmap, i) and i not in picks]
+        return list(picks) + self.rng.sample(free, min(want - len(picks), len(free)))
+
+    def sample(self, budget: int, explore: float = 0.7, neighbors: int = 4) -> List[str]:
+        chosen: Dict[int, None] = {}
+
+        def take(addr: int):
+            if addr not in chosen and not self.seen(addr) and self._locate(addr) is not None:
+                chosen[addr] = None
+
+        exploit = budget - int(budget * explore) if self.responsive else 0
+        for addr in reversed(self.responsive):
+            for delta in range(1, neighbors + 1):
+                for candidate in (addr + delta, addr - delta):
+                    if len(chosen) < exploit:
+                        take(candidate)
+        alive_strata = [(i, s) for i in range(len(self.networks)) for s in self._set_bits(self.alive[i])]
+        for _ in range(exploit * 4):
+            if len(chosen) >= exploit or not alive_strata:
+                break
+            take(self._host(*self.rng.choice(alive_strata)))
+        remaining = budget - len(chosen)
+        per_prefix = [self._unprobed(i, -(-remaining // len(self.networks))) for i in range(len(self.networks))]
+        for round_robin in itertools.zip_longest(*per_prefix):
+            for prefix, stratum in enumerate(round_robin):
+                if stratum is not None and len(chosen) < budget:
+                    take(self._host(prefix, stratum))
+        for _ in range(budget * 4):
+            # Every stratum probed at least once: keep drawing fresh hosts anywhere.
+            if len(chosen) >= budget:
+                break
+            prefix = self.rng.randrange(len(self.networks))
+            take(self._host(prefix, self.rng.randrange(self.strata[prefix])))
+        return [str(ipaddress.IPv6Address(addr)) for addr in chosen]
+
+    @staticmethod
+    def _set_bits(bitmap: bytearray) -> List[int]:
+        return [i * 8 + b for i, byte in enumerate(bitmap) if byte for b in range(8) if byte >> b & 1]
+
+    def record(self, probed: Iterable[str], responsive: Iterable[str]):
+        alive = {int(ipaddress.IPv6Address(ip)) for ip in responsive}
+        for ip in probed:
+            addr = int(ipaddress.IPv6Address(ip))
+            located = self._locate(addr)
+            if located is None:
+                continue
+            prefix, stratum = located
+            self.probed[prefix][stratum >> 3] |= 1 << (stratum & 7)
+            for p in self._bloom_positions(addr):
+                self.bloom[p >> 3] |= 1 << (p & 7)
+            if addr in alive:
+                self.alive[prefix][stratum >> 3] |= 1 << (stratum & 7)
+                if addr not in self.responsive:
+                    self.responsive.append(addr)
+        del self.responsive[:-V6_MAX_RESPONSIVE]
+        self.runs += 1
+
+    def coverage(self) -> Dict:
+        probed = sum(bin(b).count("1") for bitmap in self.probed for b in bitmap)
+        alive = sum(bin(b).count("1") for bitmap in self.alive for b in bitmap)
+        total = sum(self.strata)
+        return {"strata": total, "probed": probed, "responsive_strata": alive,
+                "responsive": len(self.responsive), "coverage": probed / total, "runs": self.runs}
+
+# --- Endpoint History ---
+class EndpointHistory:
+    """Per-(ip, port) probe history in SQLite: last/EWMA latency, EWMA loss and last-seen time.
+
+    Probe events are buffered and folded into the table in batches; the EWMA update runs inside
+    the UPSERT so a flush is a single executemany. The ``sweeps`` table remembers when each scan
+    scope was last swept in full, so incremental rescans fall back to a full sweep every ``dead_ttl``.
+    """
+
+    def __init__(self, path: str = HISTORY_FILE, alpha: float = 0.3, dead_ttl: float = 3600):
+        self.alpha = alpha
+        self.dead_ttl = dead_ttl
+        self.db = sqlite3.connect(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS endpoints (
+                ip TEXT NOT NULL,
+                port INTEGER NOT NULL,
+                last_latency REAL,
+                ewma_latency REAL,
+                loss_rate REAL NOT NULL,
+                probes INTEGER NOT NULL,
+                last_seen REAL,
+                last_probe REAL NOT NULL,
+                PRIMARY KEY (ip, port)
+            ) WITHOUT ROWID
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS endpoints_last_probe ON endpoints (last_probe)")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS path_mtu (
+                network TEXT NOT NULL,
+                ip TEXT NOT NULL,
+                port INTEGER NOT NULL,
+                payload INTEGER NOT NULL,
+                measured REAL NOT NULL,
+                PRIMARY KEY (network, ip, port)
+            ) WITHOUT ROWID
+        """)
+        self.db.execute("CREATE TABLE IF NOT EXISTS sweeps (scope TEXT PRIMARY KEY, finished REAL NOT NULL) WITHOUT ROWID")
+        self.pending: List[Tuple] = []
+
+    def record(self, ip: str, port: int, latency: Optional[float], now: Optional[float] = None):
+        now = time.time() if now is None else now
+        loss = 0.0 if latency is not None else 100.0
+        self.pending.append((ip, port, latency, latency, loss, now if latency is not None else None, now))
+        if len(self.pending) >= HISTORY_FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        a = self.alpha
+        with self.db:
+            self.db.executemany(f"""
+                INSERT INTO endpoints (ip, port, last_latency, ewma_latency, loss_rate, probes, last_seen, last_probe)
+                VALUES (?, ?, ?, ?, ?, 1, ?, ?)
+                ON CONFLICT (ip, port) DO UPDATE SET
+                    last_latency = COALESCE(excluded.last_latency, last_latency),
+                    ewma_latency = CASE
+                        WHEN excluded.last_latency IS NULL THEN ewma_latency
+                        WHEN ewma_latency IS NULL THEN excluded.last_latency
+                        ELSE ewma_latency * {1 - a} + excluded.last_latency * {a} END,
+                    loss_rate = loss_rate * {1 - a} + excluded.loss_rate * {a},
+                    probes = probes + 1,
+                    last_seen = COALESCE(excluded.last_seen, last_seen),
+                    last_probe = excluded.last_probe
+            """, self.pending)
+        self.pending = []
+
+    def promising(self, in_scope: Callable[[str, int], bool], limit: int) -> List[Tuple[str, int]]:
+        rows = self.db.execute(
+            "SELECT ip, port FROM endpoints WHERE last_seen IS NOT NULL ORDER BY loss_rate, ewma_latency"
+        )
+        return self._first_in_scope(rows, in_scope, limit)
+
+    def stale(self, in_scope: Callable[[str, int], bool], limit: int, max_age: float,
+              now: Optional[float] = None) -> List[Tuple[str, int]]:
+        """Targets that answered before but were last probed over ``max_age`` seconds ago, oldest first."""
+        cutoff = (time.time() if now is None else now) - max_age
+        rows = self.db.execute(
+            "SELECT ip, port FROM endpoints WHERE last_probe < ? AND last_seen IS NOT NULL ORDER BY last_probe", (cutoff,)
+        )
+        return self._first_in_scope(rows, in_scope, limit)
+
+    @staticmethod
+    def _first_in_scope(rows, in_scope: Callable[[str, int], bool], limit: int) -> List[Tuple[str, int]]:
+        targets = []
+        for ip, port in rows:
+            if in_scope(ip, port):
+                targets.append((ip, port))
+                if len(targets) >= limit:
+                    break
+        return targets
+
+    def host_ports(self, ip: str, ports: Optional[set] = None, now: Optional[float] = None) -> Tuple[List[int], set]:
+        """Ports of ``ip`` that have answered before (best first) and ports whose last probe failed
+        within ``dead_ttl``; one lookup on the primary key."""
+        cutoff = (time.time() if now is None else now) - self.dead_ttl
+        good, dead = [], set()
+        rows = self.db.execute("SELECT port, last_seen, last_probe FROM endpoints WHERE ip = ? ORDER BY loss_rate, ewma_latency", (ip,))
+        for port, last_seen, last_probe in rows:
+            if ports is not None and port not in ports:
+                continue
+            if last_seen is not None:
+                good.append(port)
+            if last_probe > cutoff and (last_seen is None or last_seen < last_probe):
+                dead.add(port)
+        return good, dead
+
+    def recently_dead(self, now: Optional[float] = None) -> Iterable[Tuple[str, int]]:
+        """Stream the (ip, port) pairs whose last probe failed within ``dead_ttl``.
+
+        Callers fold them into a bitmap or a set bounded by their own targets, so memory does
+        not grow with the table.
+        """
+        now = time.time() if now is None else now
+        return self.db.execute(
+            "SELECT ip, port FROM endpoints WHERE last_probe > ? AND (last_seen IS NULL OR last_seen < last_probe)",
+            (now - self.dead_ttl,)
+        )
+
+    def sweep_due(self, scope: str, now: Optional[float] = None) -> bool:
+        """True when ``scope`` has never been swept in full, or not within ``dead_ttl``."""
+        now = time.time() if now is None else now
+        row = self.db.execute("SELECT finished FROM sweeps WHERE scope = ?", (scope,)).fetchone()
+        return row is None or row[0] < now - self.dead_ttl
+
+    def mark_swept(self, scope: str, now: Optional[float] = None):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO sweeps VALUES (?, ?)", (scope, time.time() if now is None else now))
+
+    def prune(self, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        with self.db:
+            self.db.execute("DELETE FROM endpoints WHERE last_seen IS NULL AND last_probe < ?", (now - self.dead_ttl,))
+
+    def cached_mtu(self, network: str, ip: str, port: int, max_age: float, now: Optional[float] = None) -> Optional[int]:
+        now = time.time() if now is None else now
+        row = self.db.execute("SELECT payload FROM path_mtu WHERE network = ? AND ip = ? AND port = ? AND measured > ?",
+                              (network, ip, port, now - max_age)).fetchone()
+        return row[0] if row else None
+
+    def store_mtu(self, network: str, ip: str, port: int, payload: int, now: Optional[float] = None):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO path_mtu VALUES (?, ?, ?, ?, ?)",
+                            (network, ip, port, payload, time.time() if now is None else now))
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+# --- Probe Traces ---
+class ProbeTrace:
+    """Append-only binary log of probe outcomes, for re-running scoring and ranking offline.
+
+    The file is TRACE_MAGIC followed by unpadded little-endian TRACE_RECORD entries, so a trace
+    maps straight onto a numpy structured array. Records are buffered and written in batches;
+    a torn final record from an interrupted run is ignored on load.
+    """
+
+    def __init__(self, path: str, batch: int = TRACE_BATCH):
+        self.path = path
+        self.batch = batch
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(TRACE_MAGIC)
+        self.buffer = bytearray()
+        self.records = 0
+
+    def tap(self, on_probe: Callable, phase: str) -> Callable:
+        """Wrap an engine ``on_probe`` callback so every event is also recorded under ``phase``."""
+        code = TRACE_PHASES.index(phase)
+        pack, buffer, limit = TRACE_RECORD.pack, self.buffer, self.batch * TRACE_RECORD.size
+
+        def recorded(ip, port, sent_at, rtt, err):
+            packed = socket.inet_pton(socket.AF_INET6, ip) if ':' in ip else V4_MAPPED + socket.inet_aton(ip)
+            buffer.extend(pack(packed, port, err, code, sent_at, math.nan if rtt is None else rtt))
+            self.records += 1
+            if len(buffer) >= limit:
+                self.flush()
+            on_probe(ip, port, sent_at, rtt, err)
+        return recorded
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.buffer.clear()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    @staticmethod
+    def dtype():
+        return np.dtype([("ip", "S16"), ("port", "<u2"), ("err", "<u2"), ("phase", "u1"),
+                         ("sent_at", "<f8"), ("rtt", "<f4")])
+
+    @classmethod
+    def load(cls, path: str):
+        """Memory-map a trace as a structured array (fields ip, port, err, phase, sent_at, rtt)."""
+        with open(path, "rb") as f:
+            if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+                raise ValueError(f"{path} is not a probe trace")
+        dtype = cls.dtype()
+        count = (os.path.getsize(path) - len(TRACE_MAGIC)) // dtype.itemsize
+        if not count:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", offset=len(TRACE_MAGIC), shape=(count,))
+
+    @staticmethod
+    def keys(records):
+        """The (address, port) prefix of each record as one comparable 18-byte value."""
+        view = np.dtype({"names": ["key"], "formats": ["V18"], "offsets": [0], "itemsize": records.dtype.itemsize})
+        return records.view(view)["key"]
+
+    @staticmethod
+    def address(packed: bytes) -> str:
+        packed = packed.ljust(16, b"\x00")  # numpy strips trailing NULs from S16 values
+        return socket.inet_ntoa(packed[12:]) if packed[:12] == V4_MAPPED else socket.inet_ntop(socket.AF_INET6, packed)
+
+
+class TraceReplay:
+    """Serves the measurement samples recorded for each candidate in place of live probing.
+
+    ``measure`` has the signature of ``measure_candidates``: each call hands out the next
+    ``samples`` recorded RTTs per candidate. Requests past what was recorded come back as NaN
+    and are counted in ``missing``, since they would otherwise read as lost probes.
+    """
+
+    def __init__(self, records, candidates: List[Tuple[str, int]], candidate_keys):
+        measured = np.flatnonzero(records["phase"] == TRACE_PHASES.index("measure"))
+        unique, inverse = np.unique(np.concatenate([candidate_keys, ProbeTrace.keys(records)[measured]]), return_inverse=True)
+        row_of = np.full(len(unique), -1, dtype=np.int64)
+        row_of[inverse[:len(candidates)]] = np.arange(len(candidates))
+        rows = row_of[inverse[len(candidates):]]
+        keep = rows >= 0
+        rows, measured = rows[keep], measured[keep]
+        self.counts = np.bincount(rows, minlength=len(candidates))
+        # Position of each sample within its candidate, in recording order.
+        order = np.argsort(rows, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+        columns = np.empty(len(rows), dtype=np.int64)
+        columns[order] = np.arange(len(rows)) - starts[rows[order]]
+        self.samples = np.full((len(candidates), max(1, int(self.counts.max(initial=0)))), np.nan, dtype=np.float32)
+        self.samples[rows, columns] = records["rtt"][measured]
+        self.rows = {candidate: row for row, candidate in enumerate(candidates)}
+        self.cursor = np.zeros(len(candidates), dtype=np.int64)
+        self.missing = 0
+
+    def measure(self, candidates: List[Tuple[str, int]], samples: int):
+        rows = np.fromiter((self.rows[c] for c in candidates), dtype=np.int64, count=len(candidates))
+        columns = self.cursor[rows, None] + np.arange(samples)
+        padded = np.pad(self.samples, ((0, 0), (0, max(0, int(columns.max(initial=0)) + 1 - self.samples.shape[1]))),
+                        constant_values=np.nan)
+        self.missing += int(np.maximum(0, self.cursor[rows] + samples - self.counts[rows]).sum())
+        self.cursor[rows] += samples
+        return padded[rows[:, None], columns]
+
+
+# --- Path MTU Discovery ---
+def _icmp_checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(array("H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    # Summed as native-order words, so the result is packed back in native order.
+    return ~total & 0xFFFF
+
+
+class ICMPEchoEngine:
+    """Echo requests with DF set, for path MTU discovery against hosts that answer ping.
+
+    ``scan`` has the UDPScanEngine contract for ``(ip, port, payload)`` targets: each target is
+    one echo request carrying ``payload`` as its data (so the IP packet is as large as a UDP
+    datagram with that payload), and the port is only carried through to ``on_probe``. All
+    targets are sent at once and answered or timed out together, which is what PathMTUProber's
+    rounds need. Unprivileged ping sockets are used where the kernel allows them, raw sockets
+    otherwise; ``open_error`` says why neither could be opened.
+    """
+
+    def __init__(self, timeout: float = 1.0):
+        self.timeout = timeout
+        self.ident = os.getpid() & 0xFFFF
+        self.sequence = 0
+
+    @staticmethod
+    def _open(family: int) -> Tuple[socket.socket, bool]:
+        proto = socket.IPPROTO_ICMPV6 if family == socket.AF_INET6 else socket.IPPROTO_ICMP
+        error: Optional[OSError] = None
+        for kind in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            try:
+                sock = socket.socket(family, kind, proto)
+            except OSError as e:
+                error = e
+                continue
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, getattr(socket, "IPV6_MTU_DISCOVER", 23), IP_PMTUDISC_DO)
+            else:
+                sock.setsockopt(socket.IPPROTO_IP, getattr(socket, "IP_MTU_DISCOVER", 10), IP_PMTUDISC_DO)
+            sock.setblocking(False)
+            return sock, kind == socket.SOCK_RAW
+        raise error
+
+    @classmethod
+    def open_error(cls, family: int = socket.AF_INET) -> Optional[str]:
+        try:
+            sock, _ = cls._open(family)
+        except OSError as e:
+            return str(e)
+        sock.close()
+        return None
+
+    def scan(self, targets: Iterable[Tuple[str, int, bytes]], on_probe: Callable) -> int:
+        selector = selectors.DefaultSelector()
+        sockets: Dict[int, socket.socket] = {}
+        pending: Dict[Tuple[str, int], Tuple[int, float]] = {}
+        sent = 0
+        try:
+            for ip, port, payload in targets:
+                family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+                if family == socket.AF_INET6:
+                    ip = socket.inet_ntop(family, socket.inet_pton(family, ip))
+                sock = sockets.get(family)
+                if sock is None:
+                    sock, raw = self._open(family)
+                    sockets[family] = sock
+                    selector.register(sock, selectors.EVENT_READ, (family, raw))
+                self.sequence = (self.sequence + 1) & 0xFFFF
+                header = struct.pack("!BBHHH", 128 if family == socket.AF_INET6 else 8, 0, 0, self.ident, self.sequence)
+                packet = header + payload
+                if family == socket.AF_INET:
+                    packet = packet[:2] + struct.pack("=H", _icmp_checksum(packet)) + packet[4:]
+                now = time.monotonic()
+                try:
+                    sock.sendto(packet, (ip, 0))
+                except OSError as e:
+                    on_probe(ip, port, now, None, e.errno or errno.EIO)
+                    continue
+                pending[(ip, self.sequence)] = (port, now)
+                sent += 1
+            deadline = time.monotonic() + self.timeout
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for key, _ in selector.select(remaining):
+                    family, raw = key.data
+                    while True:
+                        try:
+                            data, addr = key.fileobj.recvfrom(ENGINE_RECV_SIZE)
+                        except (BlockingIOError, InterruptedError):
+                            break
+                        except OSError:
+                            break
+                        received = time.monotonic()
+                        if raw and family == socket.AF_INET:
+                            data = data[(data[0] & 0x0F) * 4:]
+                        if len(data) < 8 or data[0] != (129 if family == socket.AF_INET6 else 0):
+                            continue
+                        ident, sequence = struct.unpack("!HH", data[4:8])
+                        # Ping sockets rewrite the identifier; raw sockets see every echo reply on the host.
+                        if raw and ident != self.ident:
+                            continue
+                        entry = pending.pop((addr[0], sequence), None)
+                        if entry is not None:
+                            on_probe(addr[0], entry[0], entry[1], (received - entry[1]) * 1000, 0)
+            for (ip, _), (port, sent_at) in pending.items():
+                on_probe(ip, port, sent_at, None, errno.ETIMEDOUT)
+        finally:
+            for sock in sockets.values():
+                selector.unregister(sock)
+                sock.close()
+            selector.close()
+        return sent
+
+
+class PathMTUProber:
+    """Binary-searches the largest payload each endpoint still answers, with DF set.
+
+    All endpoints advance one step per round, so a whole candidate list costs about
+    ``log2((max - min) / granularity)`` rounds of one probe each. The first probe tries
+    ``max_payload`` since most paths carry it. A probe that times out is retried up to ``tries``
+    times before the size counts as too big (EMSGSIZE from the kernel's PMTU cache counts at once).
+    Endpoints that never answer get None.
+    """
+
+    def __init__(self, engine, min_payload: int = MTU_PROBE_MIN, max_payload: int = MTU_PROBE_MAX,
+                 granularity: int = 8, tries: int = 2, fill: bytes = b'\x01'):
+        self.engine = engine
+        self.min_payload, self.max_payload = min_payload, max_payload
+        self.granularity = max(1, granularity)
+        self.tries = tries
+        self.fill = fill
+        self.rounds = self.probes = 0
+
+    def run(self, endpoints: Iterable[Tuple[str, int]]) -> Dict[Tuple[str, int], Optional[int]]:
+        # Per endpoint: [largest answered size, smallest failed size, answered at all, failures at this size]
+        state = {endpoint: [self.min_payload - 1, self.max_payload + 1, False, 0] for endpoint in endpoints}
+        active = dict(state)
+        while active:
+            sizes = {}
+            for endpoint, (good, bad, confirmed, _) in active.items():
+                sizes[endpoint] = self.max_payload if not confirmed and bad > self.max_payload else (good + bad) // 2
+            replied, too_big = set(), set()
+
+            def on_probe(ip, port, sent_at, rtt, err):
+                if rtt is not None:
+                    replied.add((ip, port))
+                elif err == errno.EMSGSIZE:
+                    too_big.add((ip, port))
+
+            self.probes += self.engine.scan(((ip, port, self.fill + bytes(size - len(self.fill)))
+                                             for (ip, port), size in sizes.items()), on_probe)
+            self.rounds += 1
+            for endpoint, size in sizes.items():
+                entry = active[endpoint]
+                if endpoint in replied:
+                    entry[0], entry[2], entry[3] = size, True, 0
+                elif endpoint in too_big or entry[3] + 1 >= self.tries:
+                    entry[1], entry[3] = size, 0
+                else:
+                    entry[3] += 1
+                if entry[1] - entry[0] <= self.granularity:
+                    del active[endpoint]
+        return {endpoint: good if confirmed else None for endpoint, (good, _, confirmed, _) in state.items()}
+
+# --- Key Registration ---
+class TokenBucket:
+    """Thread-safe token bucket shared by all registration workers.
+
+    ``backoff`` (on HTTP 429) pauses every caller until Retry-After has passed and halves the
+    rate, once per pause however many in-flight requests were rejected; each success adds
+    ``increase`` back, up to the configured rate.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, min_rate: float = 0.2, increase: float = 0.5):
+        self.max_rate = self.rate = rate
+        self.burst = max(1, burst)
+        self.min_rate = min_rate
+        self.increase = increase
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                self.cond.wait(max(self.paused_until - now, (1.0 - self.tokens) / self.rate))
+
+    def backoff(self, retry_after: float):
+        with self.cond:
+            now = time.monotonic()
+            if now >= self.paused_until:
+                self.rate = max(self.min_rate, self.rate / 2)
+            self.paused_until = max(self.paused_until, now + retry_after)
+            self.tokens = 0.0
+            self.updated = now
+
+    def reward(self):
+        with self.cond:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class KeyRegistrar:
+    """Registers WireGuard public keys with the WARP API over per-thread keep-alive connections.
+
+    All workers draw from one TokenBucket, so a 429 from any of them slows the whole batch.
+    Transport errors and 5xx answers are retried with a fresh connection.
+    """
+
+    def __init__(self, api: str = CF_API, rate: float = 4.0, burst: int = 8, timeout: float = API_TIMEOUT,
+                 retries: int = MAX_API_RETRIES):
+        url = urllib.parse.urlsplit(api)
+        self.scheme, self.host, self.path = url.scheme, url.netloc, url.path or "/"
+        self.timeout = timeout
+        self.retries = retries
+        self.bucket = TokenBucket(rate, burst)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.open_connections: List["http.client.HTTPConnection"] = []
+        self.connections = self.requests = self.throttled = 0
+
+    @staticmethod
+    def request_body(public_key_b64: str) -> bytes:
+        return json.dumps({
+            "key": public_key_b64,
+            "install_id": "",
+            "fcm_token": "",
+            "warp_enabled": True,
+            "tos": time.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "type": "Android",
+            "locale": "en_US"
+        }).encode('utf-8')
+
+    def _connection(self) -> "http.client.HTTPConnection":
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            import http.client
+            cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            conn = self.local.conn = cls(self.host, timeout=self.timeout)
+            with self.lock:
+                self.connections += 1
+                self.open_connections.append(conn)
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def register(self, public_key_b64: str) -> dict:
+        import http.client
+        headers = {'Content-Type': 'application/json; charset=UTF-8', 'User-Agent': USER_AGENT}
+        body = self.request_body(public_key_b64)
+        error = None
+        for attempt in range(self.retries):
+            self.bucket.acquire()
+            with self.lock:
+                self.requests += 1
+            try:
+                conn = self._connection()
+                conn.request("POST", self.path, body, headers)
+                res = conn.getresponse()
+                data = res.read()
+            except (OSError, http.client.HTTPException) as e:
+                self._drop_connection()
+                error = e
+                time.sleep(min(2 ** attempt, 8) * random.uniform(0.5, 1.0))
+                continue
+            if res.status == 429:
+                with self.lock:
+                    self.throttled += 1
+                retry_after = res.getheader("Retry-After")
+                self.bucket.backoff(float(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt)
+                error = RuntimeError("HTTP 429 rate limited")
+                continue
+            if res.status >= 500:
+                self._drop_connection()
+                error = RuntimeError(f"HTTP {res.status}")
+                continue
+            if res.status >= 400:
+                raise RuntimeError(f"Failed to register key: HTTP {res.status} {data[:200]!r}")
+            self.bucket.reward()
+            return json.loads(data)
+        raise RuntimeError(f"Failed to register key: {error}")
+
+    def register_many(self, public_keys: List[str], workers: int = 8,
+                      on_done: Optional[Callable[[int, Optional[dict], Optional[Exception]], None]] = None) -> List[Optional[dict]]:
+        results: List[Optional[dict]] = [None] * len(public_keys)
+
+        def task(index: int):
+            try:
+                results[index] = self.register(public_keys[index])
+                error = None
+            except Exception as e:
+                error = e
+            if on_done:
+                on_done(index, results[index], error)
+
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            for _ in pool.map(task, range(len(public_keys))):
+                pass
+        self.close()
+        return results
+
+    def close(self):
+        with self.lock:
+            for conn in self.open_connections:
+                conn.close()
+            self.open_connections.clear()
+
+
+class PlainConsole:
+    """Stand-in for rich's Console in headless runs: drops markup and writes to stderr."""
+
+    MARKUP = re.compile(r"\[/?[a-z][^\[\]]*\]")
+
+    def __init__(self, stream=None, quiet: bool = False):
+        self.stream = stream or sys.stderr
+        self.quiet = quiet
+
+    def print(self, *objects, **kwargs):
+        if not self.quiet:
+            self.stream.write(self.MARKUP.sub("", " ".join(str(o) for o in objects)) + "\n")
+            self.stream.flush()
 
 class WarpFusionElitePro:
-    def __init__(self):
+    def __init__(self, headless: bool = False, quiet: bool = False):
+        self.headless = headless
+        self.quiet = quiet
+        if headless:
+            self.console = PlainConsole(quiet=quiet)
+        else:
+            from rich.console import Console
+            self.console = Console()
         self.config = self.load_config()
         self.setup_logging()
-        self.console = Console()
         self.ping_timeout = PING_TIMEOUT
+        # Stage-1 pinger: anything with icmplib's multiping/async_ping (the bench passes its SimulatedFarm).
+        self.icmp = icmplib
         self.port_scan_timeout = PORT_SCAN_TIMEOUT
+        self.warp_key: Optional[WarpKey] = None
+        self._handshake_probe: Optional[WireGuardProbe] = None
+        self._history: Optional[EndpointHistory] = None
+        self._registrar: Optional[KeyRegistrar] = None
+        self._mtu_cache: Dict[Tuple[str, str, int], int] = {}
+        self.controller: Optional[AIMDController] = None
+        self.on_result: Optional[Callable[[ScanResult, str], None]] = None
+        self.probes_sent = 0
+        metrics_cfg = self.config["metrics"]
+        self.metrics = ScanMetrics(profile=metrics_cfg["profile"], trace_memory=metrics_cfg["tracemalloc"])
+        self.trace: Optional[ProbeTrace] = None
+
+    def open_trace(self, path: Optional[str] = None) -> Optional[ProbeTrace]:
+        """Record probes to ``path`` (default ``trace.record_file``), closing any trace already open."""
+        self.close_trace()
+        path = path or self.config["trace"]["record_file"]
+        self.trace = ProbeTrace(path) if path else None
+        return self.trace
+
+    def close_trace(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
 
     def load_config(self) -> Dict:
         if not os.path.exists(CONFIG_FILE):
@@ -130,23 +2006,76 @@ class WarpFusionElitePro:
                 json.dump(DEFAULT_CONFIG, f, indent=2)
         try:
             with open(CONFIG_FILE, "r") as f:
-                return json.load(f)
+                return self._merge_config(DEFAULT_CONFIG, json.load(f))
         except json.JSONDecodeError:
             self.console.print("[yellow]⚠️ Corrupted config file. Using default configuration.[/yellow]")
-            return DEFAULT_CONFIG
+            return self._merge_config(DEFAULT_CONFIG, {})
+
+    @staticmethod
+    def _merge_config(defaults: Dict, overrides: Dict) -> Dict:
+        merged = {}
+        for key, value in defaults.items():
+            if isinstance(value, dict):
+                merged[key] = WarpFusionElitePro._merge_config(value, overrides.get(key) or {})
+            else:
+                merged[key] = overrides.get(key, value)
+        for key, value in overrides.items():
+            merged.setdefault(key, value)
+        return merged
 
     def setup_logging(self):
         os.makedirs(LOG_DIR, exist_ok=True)
         logging.basicConfig(
             level=logging.INFO,
             format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(os.path.join(LOG_DIR, "warpfusion.log")),
-                logging.StreamHandler()
-            ]
+            handlers=[logging.FileHandler(os.path.join(LOG_DIR, "warpfusion.log"))]
+            + ([] if self.quiet else [logging.StreamHandler()])
         )
 
+    def export_metrics(self, prometheus_file: Optional[str] = None, json_file: Optional[str] = None) -> List[str]:
+        metrics_cfg = self.config["metrics"]
+        prometheus_file = prometheus_file or metrics_cfg["prometheus_file"]
+        json_file = json_file or metrics_cfg["json_file"]
+        phases = ", ".join(f"{name} {stats['wall_s']:.2f}s/{stats['cpu_s']:.2f}s cpu" for name, stats in self.metrics.phases.items())
+        logging.info("Scan metrics: %d probes, %d replies, %d timeouts, %d errors; %s", self.metrics.probes_sent,
+                     self.metrics.replies, self.metrics.timeouts, sum(self.metrics.errors.values()), phases or "no phases")
+        written = []
+        try:
+            self.metrics.dump_profiles()
+            if prometheus_file:
+                self.metrics.write_prometheus(prometheus_file)
+                written.append(prometheus_file)
+            if json_file:
+                self.metrics.write_json(json_file, self.controller)
+                written.append(json_file)
+        except OSError as e:
+            self.console.print(f"[yellow]⚠️ Failed to export metrics: {e}[/yellow]")
+        return written
+
+    @contextlib.contextmanager
+    def progress(self, description: str, total: int, ranking: Optional[LiveRanking] = None):
+        """Progress bar; with a ``ranking`` (and scan.live) the current leaders render live beneath it."""
+        if self.headless:
+            yield lambda advance=1: None
+            return
+        from rich.progress import Progress, BarColumn, TimeRemainingColumn, TextColumn
+        columns = (TextColumn(f"[cyan]{description}[/cyan]"), BarColumn(), "[progress.percentage]{task.percentage:>3.0f}%", TimeRemainingColumn())
+        if ranking is None or not self.config["scan"]["live"]:
+            with Progress(*columns, transient=True) as progress:
+                task = progress.add_task("", total=total)
+                yield lambda advance=1: progress.update(task, advance=advance)
+            return
+        from rich.console import Group
+        from rich.live import Live
+        progress = Progress(*columns)
+        task = progress.add_task("", total=total)
+        title = "[bold magenta]📶 Leading endpoints[/bold magenta]"
+        with Live(console=self.console, transient=True, refresh_per_second=4,
+                  get_renderable=lambda: Group(progress, self._results_table([c.result() for c in ranking.leading()], title))):
+            yield lambda advance=1: progress.update(task, advance=advance)
+
     def print_banner(self):
+        from rich.panel import Panel
         banner = f"""
 [bold cyan]██╗    ██╗ █████╗ ██████╗ ██████╗ ███████╗██╗   ██╗███████╗██╗ ██████╗ ███╗   ██╗[/bold cyan]
 [bold cyan]██║    ██║██╔══██╗██╔══██╗██╔══██╗██╔════╝██║   ██║██╔════╝██║██╔═══██╗████╗  ██║[/bold cyan]
@@ -180,6 +2109,8 @@ class WarpFusionElitePro:
                 self.console.print(f"[red]❌ Failed to install WireGuard tools: {install_cmd}[/red]")
                 sys.exit(1)
 
+        import urllib.error
+        import urllib.request
         try:
             urllib.request.urlopen(TEST_URL, timeout=5)
             self.console.print("[green]✅ Internet connection verified.[/green]")
@@ -214,29 +2145,46 @@ class WarpFusionElitePro:
 
     def detect_network_quality(self):
         self.console.print("[bold]📡 Assessing network quality...[/bold]")
+        latency = None
         try:
-            host = multiping(["1.1.1.1"], count=PING_COUNT, timeout=2, privileged=False)[0]
+            host = icmplib.multiping(["1.1.1.1"], count=PING_COUNT, timeout=2, privileged=False)[0]
             if not host.is_alive:
                 raise ValueError("No response from ping target")
             latency = host.avg_rtt
             if latency < 100:
                 status = f"[green]Excellent ({latency:.0f}ms)[/green]"
-                self.ping_timeout, self.port_scan_timeout = 2.0, 1.0
-                self.config["scan"]["max_threads"] = 150
             elif latency < 250:
                 status = f"[yellow]Good ({latency:.0f}ms)[/yellow]"
-                self.ping_timeout, self.port_scan_timeout = 3.0, 1.5
-                self.config["scan"]["max_threads"] = 100
             else:
                 status = f"[red]Poor ({latency:.0f}ms)[/red]"
-                self.ping_timeout, self.port_scan_timeout = 4.0, 2.0
-                self.config["scan"]["max_threads"] = 50
+            # ICMP waits for all PING_COUNT replies, so allow a few RTTs plus headroom.
+            self.ping_timeout = min(max(latency * 4 / 1000 + 1.0, PING_TIMEOUT), 4.0)
             self.console.print(f"   Network quality: {status}")
         except Exception as e:
             self.console.print(f"[yellow]⚠️ Network quality detection failed: {e}. Using defaults.[/yellow]")
+        self.controller = self.create_controller(latency)
+        if self.controller:
+            self.port_scan_timeout = self.controller.timeout
+            self.console.print(f"   Adaptive scan: {self.controller.window} in-flight, {self.controller.rate:.0f} pkt/s, "
+                               f"{self.controller.timeout * 1000:.0f}ms timeout (self-tuning)")
+
+    def create_controller(self, initial_rtt: Optional[float] = None, shards: int = 1,
+                          initial_timeout: Optional[float] = None) -> Optional[AIMDController]:
+        adaptive = dict(self.config["adaptive"])
+        if not adaptive.pop("enabled"):
+            return None
+        # Each scan worker gets an equal slice of the window and rate budget.
+        for key in ("max_inflight", "initial_inflight", "increase_inflight"):
+            adaptive[key] = max(1, adaptive[key] // shards)
+        for key in ("max_rate", "initial_rate", "increase_rate"):
+            adaptive[key] = adaptive[key] / shards
+        adaptive["min_inflight"] = min(adaptive["min_inflight"], adaptive["max_inflight"])
+        adaptive["min_rate"] = min(adaptive["min_rate"], adaptive["max_rate"])
+        log_path = os.path.join(LOG_DIR, "aimd_decisions.jsonl") if adaptive.pop("log_decisions") else None
+        return AIMDController(initial_rtt=initial_rtt, log_path=log_path, initial_timeout=initial_timeout, **adaptive)
 
     def generate_wg_keys(self) -> Tuple[bytes, bytes]:
-        private_key = X25519PrivateKey.generate()
+        private_key = x25519.X25519PrivateKey.generate()
         public_key = private_key.public_key()
         return (
             private_key.private_bytes(
@@ -250,36 +2198,26 @@ class WarpFusionElitePro:
             )
         )
 
+    @property
+    def registrar(self) -> KeyRegistrar:
+        if self._registrar is None:
+            reg_cfg = self.config["registration"]
+            self._registrar = KeyRegistrar(reg_cfg["api"], reg_cfg["rate"], reg_cfg["burst"])
+        return self._registrar
+
     def register_warp_key(self, public_key_b64: str) -> dict:
-        headers = {
-            'Content-Type': 'application/json; charset=UTF-8',
-            'User-Agent': USER_AGENT
-        }
-        data = json.dumps({
-            "key": public_key_b64,
-            "install_id": "",
-            "fcm_token": "",
-            "warp_enabled": True,
-            "tos": time.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
-            "type": "Android",
-            "locale": "en_US"
-        }).encode('utf-8')
-        for attempt in range(MAX_API_RETRIES):
-            try:
-                req = urllib.request.Request(CF_API, data=data, headers=headers)
-                with urllib.request.urlopen(req, timeout=API_TIMEOUT) as res:
-                    return json.load(res)
-            except urllib.error.HTTPError as e:
-                if e.code == 429:
-                    wait_time = 2 ** attempt
-                    self.console.print(f"[yellow]⚠️ API rate limit. Retrying in {wait_time}s...[/yellow]")
-                    time.sleep(wait_time)
-                else:
-                    raise
-            except Exception as e:
-                if attempt == MAX_API_RETRIES - 1:
-                    raise RuntimeError(f"Failed to register key: {e}")
-                time.sleep(1)
+        return self.registrar.register(public_key_b64)
+
+    @staticmethod
+    def _warp_key_from_api(priv_key_b64: str, api_config: dict) -> WarpKey:
+        return WarpKey(
+            private_key=priv_key_b64,
+            public_key=api_config['config']['peers'][0]['public_key'],
+            client_id=api_config['config']['client_id'],
+            address_v4=api_config['config']['interface']['addresses']['v4'],
+            address_v6=api_config['config']['interface']['addresses']['v6'],
+            last_updated=time.strftime("%Y-%m-%d %H:%M:%S")
+        )
 
     def create_warp_key(self) -> WarpKey:
         self.console.print("[bold]🔑 Generating and registering new Warp key...[/bold]")
@@ -287,104 +2225,722 @@ class WarpFusionElitePro:
         priv_key_b64 = base64.b64encode(priv_key_bytes).decode('utf-8')
         pub_key_b64 = base64.b64encode(pub_key_bytes).decode('utf-8')
         try:
-            api_config = self.register_warp_key(pub_key_b64)
-            return WarpKey(
-                private_key=priv_key_b64,
-                public_key=api_config['config']['peers'][0]['public_key'],
-                client_id=api_config['config']['client_id'],
-                address_v4=api_config['config']['interface']['addresses']['v4'],
-                address_v6=api_config['config']['interface']['addresses']['v6'],
-                last_updated=time.strftime("%Y-%m-%d %H:%M:%S")
-            )
+            return self._warp_key_from_api(priv_key_b64, self.register_warp_key(pub_key_b64))
         except Exception as e:
             self.console.print(f"[red]❌ Failed to create Warp key: {e}[/red]")
             sys.exit(1)
 
+    def create_warp_keys(self, count: int, workers: Optional[int] = None) -> Tuple[List[WarpKey], List[str]]:
+        """Generate and register ``count`` keys concurrently; returns the keys and the errors."""
+        self.console.print(f"[bold]🔑 Generating and registering {count} Warp keys...[/bold]")
+        pairs = [self.generate_wg_keys() for _ in range(count)]
+        private = [base64.b64encode(priv).decode('utf-8') for priv, _ in pairs]
+        public = [base64.b64encode(pub).decode('utf-8') for _, pub in pairs]
+        keys: List[WarpKey] = []
+        errors: List[str] = []
+        with self.progress("Registering keys...", count) as advance:
+
+            def on_done(index, api_config, error):
+                advance()
+                if error is None:
+                    try:
+                        keys.append(self._warp_key_from_api(private[index], api_config))
+                        return
+                    except (KeyError, IndexError, TypeError) as e:
+                        error = RuntimeError(f"Unexpected API response: {e}")
+                errors.append(str(error))
+
+            self.registrar.register_many(public, workers or self.config["registration"]["workers"], on_done)
+        return keys, errors
+
+    def save_key_pool(self, keys: List[WarpKey], path: Optional[str] = None) -> int:
+        """Merge ``keys`` into the key pool file; returns the pool size."""
+        path = path or self.config["registration"]["pool_file"]
+        pool = []
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    pool = json.load(f)
+            except json.JSONDecodeError:
+                self.console.print(f"[yellow]⚠️ Corrupted key pool {path}. Starting a new one.[/yellow]")
+        pool.extend(key.__dict__ for key in keys)
+        write_atomic(path, json.dumps(pool, indent=2), mode=0o600)
+        return len(pool)
+
+    def load_key_pool(self, path: Optional[str] = None) -> List[WarpKey]:
+        path = path or self.config["registration"]["pool_file"]
+        with open(path, 'r') as f:
+            return [WarpKey(**{k: entry[k] for k in WarpKey.__annotations__}) for entry in json.load(f)]
+
     def load_or_create_key(self) -> WarpKey:
         if os.path.exists(CONFIG_FILE):
             try:
                 with open(CONFIG_FILE, 'r') as f:
                     data = json.load(f)
                 if all(k in data for k in WarpKey.__annotations__):
-                    return WarpKey(**data)
+                    self.warp_key = WarpKey(**data)
+                    return self.warp_key
             except (json.JSONDecodeError, KeyError, TypeError):
                 self.console.print("[yellow]⚠️ Invalid key config. Generating new key...[/yellow]")
         warp_key = self.create_warp_key()
         with open(CONFIG_FILE, 'w') as f:
             json.dump(warp_key.__dict__, f, indent=4)
+        self.warp_key = warp_key
         return warp_key
 
+    def ipv6_sampler(self) -> IPv6Sampler:
+        v6 = self.config["ipv6"]
+        return IPv6Sampler(v6["prefixes"], v6["stratum"], v6["coverage_file"], v6["bloom_bits"], v6["bloom_hashes"])
+
+    def _icmp_candidates(self, ipv6=False) -> Tuple[List[str], Optional[IPv6Sampler]]:
+        if not ipv6:
+            return self.config["scan"]["endpoints"], None
+        v6 = self.config["ipv6"]
+        sampler = self.ipv6_sampler()
+        return sampler.sample(v6["budget"], v6["explore"], v6["neighbors"]), sampler
+
+    def _record_coverage(self, sampler: Optional[IPv6Sampler], endpoints: List[str], alive: Iterable[str]):
+        if sampler is None:
+            return
+        sampler.record(endpoints, alive)
+        sampler.save()
+        cov = sampler.coverage()
+        self.console.print(f"[cyan]🧭 IPv6 coverage: {cov['probed']}/{cov['strata']} /{sampler.stratum} strata probed "
+                           f"({cov['coverage']:.2%}), {cov['responsive']} responsive addresses known.[/cyan]")
+
     def _filter_active_endpoints(self, ipv6=False) -> List[Tuple[str, float]]:
-        endpoints = WARP_ENDPOINTS if not ipv6 else [f"2606:4700:d{random.randint(0,1)}::{random.randint(0,65535):x}:{random.randint(0,65535):x}" for _ in range(100)]
-        with Progress(TextColumn("[cyan]Filtering active endpoints...[/cyan]"), BarColumn(), TimeRemainingColumn(), transient=True) as progress:
-            task = progress.add_task("", total=len(endpoints))
-            hosts = multiping(endpoints, count=PING_COUNT, timeout=self.ping_timeout, privileged=False)
-            progress.update(task, completed=len(endpoints))
-        return [(h.address, h.avg_rtt) for h in hosts if h.is_alive]
-
-    def _test_port_connection(self, ip: str, port: int) -> Optional[Tuple[float, float, float]]:
+        endpoints, sampler = self._icmp_candidates(ipv6)
+        with self.metrics.phase("icmp_filter"), self.progress("Filtering active endpoints...", len(endpoints)) as advance:
+            hosts = self.icmp.multiping(endpoints, count=PING_COUNT, timeout=self.ping_timeout, privileged=False)
+            advance(len(endpoints))
+        active = [(h.address, h.avg_rtt) for h in hosts if h.is_alive]
+        self._record_coverage(sampler, endpoints, [ip for ip, _ in active])
+        return active
+
+    def _icmp_stream(self, endpoints: List[str], admit: Callable[[str, float], None], advance: Callable,
+                     stop: Optional[threading.Event] = None) -> List[Optional[bool]]:
+        """Ping every endpoint concurrently and ``admit`` each one as soon as its first echo returns.
+
+        Each host gets PING_COUNT single pings staggered by PING_INTERVAL, so a lost echo costs
+        one interval instead of holding the host back until the whole batch times out. Setting
+        ``stop`` cancels the outstanding pings; those hosts come back as None rather than dead.
+        """
+        async def once(address: str, delay: float):
+            await asyncio.sleep(delay)
+            try:
+                return await self.icmp.async_ping(address, count=1, timeout=self.ping_timeout, privileged=False)
+            except (icmplib.ICMPError, icmplib.TimeoutExceeded):
+                # Unreachable or expired in transit; permission and socket errors propagate.
+                return None
+
+        async def probe(address: str) -> bool:
+            attempts = [asyncio.ensure_future(once(address, i * PING_INTERVAL)) for i in range(PING_COUNT)]
+            try:
+                for attempt in asyncio.as_completed(attempts):
+                    host = await attempt
+                    if host is not None and host.is_alive:
+                        admit(host.address, host.avg_rtt)
+                        return True
+                return False
+            finally:
+                for attempt in attempts:
+                    attempt.cancel()
+                advance()
+
+        async def run():
+            tasks = [asyncio.ensure_future(probe(address)) for address in endpoints]
+            pending = set(tasks)
+            while pending and not (stop is not None and stop.is_set()):
+                _, pending = await asyncio.wait(pending, timeout=PING_INTERVAL if stop is not None else None)
+            # Cancel the hosts still pending and their individual pings. wait_for inside icmplib can
+            # swallow a cancel that races an arriving packet, so repeat until every task is gone.
+            while pending:
+                for task in pending:
+                    task.cancel()
+                await asyncio.wait(pending, timeout=PING_INTERVAL / 10)
+                pending = asyncio.all_tasks() - {asyncio.current_task()}
+            return [None if task.cancelled() else task.result() for task in tasks]
+
+        return asyncio.run(run())
+
+    def _pipelined_scan(self, ipv6=False, ports: Optional[List[int]] = None) -> List[ScanResult]:
+        """ICMP filtering and port probing as one pipeline: every host that answers a ping is
+        queued for port probing right away, and replies go into a bounded top-k while pings are
+        still outstanding. The first DEEP_SCAN_HOSTS responders are taken, which favours the
+        nearest hosts just as sorting by ping RTT did.
+
+        With history, each admitted host's known-good ports are probed first and its recently
+        dead ports skipped. On an incremental rescan the remaining ports of such hosts are held
+        back until all known-good probes have finished, and are dropped if those already filled
+        the top list; once the last full sweep is older than ``dead_ttl`` nothing is dropped.
+        """
+        ports = ports or WARP_PORTS
+        endpoints, sampler = self._icmp_candidates(ipv6)
+        ranking = self.live_ranking()
+        history = self.history
+        scope = self._sweep_scope("endpoints", ipv6, tuple(ports))
+        incremental = history is not None and self.config["history"]["incremental"] and not history.sweep_due(scope)
+        top_n = self.config["scan"]["top_n"]
+        admitted: Dict[str, float] = {}
+        queue = deque()
+        held: List[Tuple[str, List[int]]] = []
+        known: set = set()
+        known_state = [0, 0]  # known-good probes outstanding, known-good replies
+        dropped = [False]
+        stage1_done, stop_pings = threading.Event(), threading.Event()
+        alive: List[bool] = []
+        failure: List[BaseException] = []
+
+        def admit(ip: str, rtt: float):
+            if len(admitted) < DEEP_SCAN_HOSTS:
+                admitted[ip] = rtt
+                queue.append(ip)
+
+        def targets():
+            while True:
+                finished = stage1_done.is_set()
+                if queue:
+                    ip = queue.popleft()
+                    if history is None:
+                        for port in ports:
+                            yield ip, port
+                        continue
+                    good, dead = history.host_ports(ip, port_scope)
+                    rest = [port for port in ports if port not in dead and port not in good]
+                    known.update((ip, port) for port in good)
+                    known_state[0] += len(good)
+                    for port in good:
+                        yield ip, port
+                    if incremental and good:
+                        held.append((ip, rest))
+                    else:
+                        for port in rest:
+                            yield ip, port
+                elif not finished:
+                    yield None
+                elif held:
+                    while known_state[0] > 0 and known_state[1] < top_n:
+                        yield None
+                    if known_state[1] >= top_n:
+                        dropped[0] = True
+                        return
+                    for ip, rest in held:
+                        for port in rest:
+                            yield ip, port
+                    held.clear()
+                else:
+                    return
+
+        def on_probe(ip, port, sent_at, rtt, err):
+            if (ip, port) in known:
+                known.discard((ip, port))
+                known_state[0] -= 1
+                known_state[1] += rtt is not None
+            if rtt is not None:
+                self._keep_reply(ranking, ip, port, rtt)
+
+        # phase() is not thread-safe: each stage times itself and both are accounted after the join.
+        stage_times: Dict[str, Tuple[float, float]] = {}
+        with self.metrics.phase("pipeline"), self.progress("Pinging and scanning ports...", len(endpoints), ranking) as advance:
+
+            def stage1():
+                wall, cpu = time.perf_counter(), time.thread_time()
+                try:
+                    alive.extend(self._icmp_stream(endpoints, admit, advance, stop_pings))
+                except BaseException as e:
+                    failure.append(e)
+                finally:
+                    stage_times["icmp_filter"] = (time.perf_counter() - wall, time.thread_time() - cpu)
+                    stage1_done.set()
+
+            pinger = threading.Thread(target=stage1, daemon=True)
+            pinger.start()
+            port_scope = set(ports)
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                self._run_scan(targets(), on_probe, None, ranking.stable)
+            finally:
+                # Only an early exit (top list settled) or an error gets here with pings outstanding.
+                stop_pings.set()
+                pinger.join()
+            stage_times["port_scan"] = (time.perf_counter() - wall, time.thread_time() - cpu)
+            if history is not None and not dropped[0] and ranking.settled_at is None:
+                history.mark_swept(scope)
+        for name, (wall, cpu) in stage_times.items():
+            self.metrics.add_phase(name, wall, cpu)
+        if failure:
+            raise failure[0]
+        probed = [ip for ip, ok in zip(endpoints, alive) if ok is not None]
+        self._record_coverage(sampler, probed, [ip for ip, ok in zip(endpoints, alive) if ok])
+        if not admitted:
+            self.console.print("[red]❌ No active endpoints found.[/red]")
+            return []
+        self.console.print(f"[green]✅ Found {len(admitted)} active endpoints.[/green]")
+        results = self._rank_top(ranking)
+        if not results:
+            self.console.print("[red]❌ No viable ports found.[/red]")
+        return results
+
+    def live_ranking(self) -> LiveRanking:
+        scan_cfg = self.config["scan"]
+        k = scan_cfg["top_n"] * (CANDIDATE_FACTOR if scan_cfg["samples"] > 1 else 1)
+        return LiveRanking(k, self.score_weights, scan_cfg["top_n"], scan_cfg["stable_for"])
+
+    def _keep_reply(self, ranking: LiveRanking, ip: str, port: int, rtt: float):
+        candidate = ranking.add(ip, port, rtt)
+        if self.on_result:
+            result = candidate.result() if candidate else ScanResult(ip=ip, port=port, latency=rtt, packet_loss=0.0, jitter=0.0,
+                                                                     score=score_endpoint(rtt, 0.0, 0.0, ranking.weights))
+            self.on_result(result, "discovered")
+
+    def _note_early_exit(self, ranking: LiveRanking):
+        if ranking.settled_at is not None:
+            self.console.print(f"[green]⏱️ Top {ranking.leaders.k} unchanged for {ranking.stable_for:g}s, "
+                               f"stopped early after {ranking.replies} replies.[/green]")
+
+    def _rank_top(self, ranking: LiveRanking) -> List[ScanResult]:
+        self._note_early_exit(ranking)
+        if self.config["scan"]["samples"] > 1:
+            return self.rank_candidates([(c.ip, c.port) for c in ranking.candidates()])
+        return [c.result() for c in ranking.candidates()]
+
+    def handshake_probe(self) -> WireGuardProbe:
+        if self.warp_key is None:
+            raise RuntimeError("Handshake probing requires a Warp key; call load_or_create_key() first.")
+        if self._handshake_probe is None or self._handshake_probe.peer_public != base64.b64decode(self.warp_key.public_key):
+            self._handshake_probe = WireGuardProbe(self.warp_key)
+        return self._handshake_probe
+
+    def _scan_engine(self) -> UDPScanEngine:
+        scan_cfg = self.config["scan"]
+        payload, reply_filter = b'\x01', None
+        if scan_cfg["probe"] == "handshake":
+            probe = self.handshake_probe()
+            payload, reply_filter = probe.build_initiation, probe.is_response
+        return UDPScanEngine(
+            timeout=self.port_scan_timeout,
+            max_inflight=scan_cfg["max_inflight"],
+            payload=payload,
+            sockets_per_family=scan_cfg["sockets"],
+            rate=scan_cfg["rate"],
+            reply_filter=reply_filter,
+            controller=self.controller,
+            metrics=self.metrics
+        )
+
+    @property
+    def history(self) -> Optional[EndpointHistory]:
+        history_cfg = self.config["history"]
+        if self._history is None and history_cfg["enabled"]:
+            self._history = EndpointHistory(history_cfg["path"], history_cfg["ewma_alpha"], history_cfg["dead_ttl"])
+            self._history.prune()
+        return self._history
+
+    @property
+    def scan_workers(self) -> int:
+        workers = self.config["scan"]["workers"]
+        return (os.cpu_count() or 1) if workers == "auto" else max(1, int(workers))
+
+    def _shard_worker(self, space: TargetSpace, shard: int, shards: int, skip: Optional[bytearray], conn):
+        # Runs in a forked child: its own controller slice, sockets, event loop and counters.
+        try:
+            self.metrics = ScanMetrics()
+            if self.controller is not None:
+                self.controller = self.create_controller(self.controller.srtt, shards, self.controller.timeout)
+            engine = self._scan_engine()
+            engine.max_inflight = max(1, engine.max_inflight // shards)
+            engine.rate = engine.rate / shards
+            batch = bytearray()
+            pack = SHARD_RECORD.pack
+
+            def on_probe(ip, port, sent_at, rtt, err):
+                packed = socket.inet_pton(socket.AF_INET6, ip) if ':' in ip else V4_MAPPED + socket.inet_aton(ip)
+                batch.extend(pack(packed, port, err, sent_at, math.nan if rtt is None else rtt))
+                if len(batch) >= SHARD_BATCH * SHARD_RECORD.size:
+                    conn.send_bytes(b"R" + batch)
+                    batch.clear()
+
+            sent = engine.scan(space.iter_shard(shard, shards, skip), on_probe)
+            if batch:
+                conn.send_bytes(b"R" + batch)
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            conn.send_bytes(b"D" + json.dumps({
+                "sent": sent, "metrics": self.metrics.state(),
+                "controller": self.controller.state() if self.controller is not None else None,
+                "rusage": {"cpu_s": usage.ru_utime + usage.ru_stime, "max_rss_kb": usage.ru_maxrss}
+            }).encode())
+        except BaseException as e:
+            conn.send_bytes(b"E" + f"shard {shard}: {e!r}".encode())
+        finally:
+            conn.close()
+
+    def _sharded_scan(self, space: TargetSpace, on_probe: Callable, skip: Optional[bytearray] = None, shards: int = 2,
+                      stop_when: Optional[Callable[[], bool]] = None) -> int:
+        """Sweep ``space`` with one forked worker per shard; replies stream back as SHARD_RECORD batches.
+
+        Workers each take every ``shards``-th position of the permutation. The parent only decodes
+        records and calls ``on_probe``, so callers keep a bounded top-k instead of a result list.
+        When ``stop_when`` fires, the remaining workers are terminated and their probe counts are lost.
+        """
+        from multiprocessing.connection import wait
+        context = multiprocessing.get_context("fork")
+        workers = {}
+        for shard in range(shards):
+            reader, writer = context.Pipe(duplex=False)
+            process = context.Process(target=self._shard_worker, args=(space, shard, shards, skip, writer), daemon=True)
+            process.start()
+            writer.close()
+            workers[reader] = process
+        sent, errors = 0, []
+        unpack = SHARD_RECORD.iter_unpack
+        try:
+            while workers and not (stop_when is not None and stop_when()):
+                for conn in wait(list(workers)):
+                    try:
+                        message = conn.recv_bytes()
+                    except EOFError:
+                        errors.append(f"worker {workers[conn].pid} exited early")
+                        message = b"D"
+                    kind, body = message[:1], memoryview(message)[1:]
+                    if kind == b"R":
+                        for packed, port, err, sent_at, rtt in unpack(body):
+                            ip = socket.inet_ntoa(packed[12:]) if packed[:12] == V4_MAPPED else socket.inet_ntop(socket.AF_INET6, packed)
+                            on_probe(ip, port, sent_at, None if rtt != rtt else rtt, err)
+                        continue
+                    if kind == b"D" and len(body):
+                        done = json.loads(bytes(body))
+                        sent += done["sent"]
+                        self.metrics.merge(done["metrics"])
+                        self.metrics.merge_worker_usage(done["rusage"])
+                        if self.controller is not None and done["controller"]:
+                            self.controller.merge(done["controller"])
+                    elif kind == b"E":
+                        errors.append(bytes(body).decode())
+                    workers.pop(conn).join()
+                    conn.close()
+        finally:
+            for conn, process in workers.items():
+                process.terminate()
+                conn.close()
+        if errors:
+            raise RuntimeError("Sharded scan failed: " + "; ".join(errors))
+        return sent
+
+    def _sweep(self, engine: UDPScanEngine, targets: Iterable[Tuple[str, int]], on_probe: Callable, skip=None) -> int:
+        """``skip`` is a TargetSpace bitmap when ``targets`` is a TargetSpace, otherwise a set of targets."""
+        if isinstance(targets, TargetSpace):
+            shards = self.scan_workers
+            if shards > 1 and "fork" in multiprocessing.get_all_start_methods():
+                return self._sharded_scan(targets, on_probe, skip, shards, engine.stop_when)
+            return engine.scan(targets.iter_shard(0, 1, skip), on_probe)
+        return engine.scan((t for t in targets if t not in skip) if skip else targets, on_probe)
+
+    @staticmethod
+    def _sweep_scope(*parts) -> str:
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def _run_scan(self, targets: Iterable[Tuple[str, int]], on_probe: Callable, in_scope: Optional[Callable[[str, int], bool]],
+                  stop_when: Optional[Callable[[], bool]] = None, scope: Optional[str] = None) -> int:
+        """Probe ``targets``, recording outcomes into history. With an ``in_scope`` test the
+        history's known-good targets in scope go first; pass None when ``targets`` already
+        orders itself by history (the pipelined scan does this per admitted host). A sweep of
+        ``scope`` that runs to the end is recorded; the known targets may only stand in for it
+        while that record is younger than ``history.dead_ttl``."""
+        engine = self._scan_engine()
+        engine.stop_when = stop_when
+        if self.trace:
+            on_probe = self.trace.tap(on_probe, "discover")
+        history = self.history
+        if history is None:
+            sent = self._sweep(engine, targets, on_probe)
+            self.probes_sent += sent
+            if self.trace:
+                self.trace.flush()
+            return sent
+        replies = [0]
+
+        def recorded(ip, port, sent_at, rtt, err):
+            history.record(ip, port, rtt)
+            if rtt is not None:
+                replies[0] += 1
+            on_probe(ip, port, sent_at, rtt, err)
+
+        if in_scope is None:
+            sent = self._sweep(engine, targets, recorded)
+            history.flush()
+            if self.trace:
+                self.trace.flush()
+            self.probes_sent += sent
+            return sent
+        # Stale then known-good targets go first; a routine rescan stops there when they already
+        # yield a full top list, otherwise (or once the last full sweep is older than dead_ttl)
+        # the sweep continues minus recently dead targets.
+        history_cfg = self.config["history"]
+        incremental = history_cfg["incremental"] and not (scope is not None and history.sweep_due(scope))
+        limit = history_cfg["promising_limit"]
+        known = list(dict.fromkeys(history.stale(in_scope, limit, history_cfg["stale_after"])
+                                   + history.promising(in_scope, limit)))[:limit]
+        sent = engine.scan(known, recorded)
+        settled = stop_when is not None and stop_when()
+        if not settled and not (incremental and replies[0] >= self.config["scan"]["top_n"]):
+            dead = itertools.chain(history.recently_dead(), known)
+            if isinstance(targets, TargetSpace):
+                skip = targets.bitmap(dead)
+            else:
+                skip = {target for target in dead if in_scope(*target)}
+            sent += self._sweep(engine, targets, recorded, skip)
+            if scope is not None and not (stop_when is not None and stop_when()):
+                history.mark_swept(scope)
+        history.flush()
+        if self.trace:
+            self.trace.flush()
+        self.probes_sent += sent
+        return sent
+
+    def _deep_scan_ports(self, ips: List[str], ports: Optional[List[int]] = None) -> List[ScanResult]:
+        """Probe every ip × port; returns the best replies (top_n, or top_n × CANDIDATE_FACTOR
+        when multi-sample ranking follows) ordered by single-shot score."""
+        ports = ports or WARP_PORTS
+        ranking = self.live_ranking()
+        total_tasks = len(ips) * len(ports)
+        with self.metrics.phase("port_scan"), self.progress("Scanning ports...", total_tasks, ranking) as advance:
+
+            def on_probe(ip, port, sent_at, rtt, err):
+                advance()
+                if rtt is not None:
+                    self._keep_reply(ranking, ip, port, rtt)
+
+            scope, port_scope = set(ips), set(ports)
+            # The responders change from run to run, so the full-sweep record is kept per family and port set.
+            self._run_scan(((ip, port) for ip in ips for port in ports), on_probe,
+                           lambda ip, port: ip in scope and port in port_scope, ranking.stable,
+                           self._sweep_scope("endpoints", any(':' in ip for ip in ips[:1]), tuple(ports)))
+        self._note_early_exit(ranking)
+        return [c.result() for c in ranking.candidates()]
+
+    def scan_ranges(self, ranges: Optional[List[str]] = None, ports: Optional[List[int]] = None) -> List[ScanResult]:
+        space = TargetSpace(ranges or self.config["scan"]["ranges"], ports or WARP_PORTS)
+        ranking = self.live_ranking()
+        self.console.print(f"[cyan]📡 Sweeping {space.addresses} addresses × {len(space.ports)} ports ({len(space)} targets)...[/cyan]")
+        with self.metrics.phase("port_scan"), self.progress("Scanning ranges...", len(space), ranking) as advance:
+            done = [0]
+
+            def on_probe(ip, port, sent_at, rtt, err):
+                done[0] += 1
+                if done[0] == PROGRESS_BATCH:
+                    advance(done[0])
+                    done[0] = 0
+                if rtt is not None:
+                    self._keep_reply(ranking, ip, port, rtt)
+
+            self._run_scan(space, on_probe, space.contains, ranking.stable,
+                           self._sweep_scope("ranges", tuple(sorted(ranges or self.config["scan"]["ranges"])), tuple(space.ports)))
+        return self._rank_top(ranking)
+
+    @property
+    def score_weights(self) -> Tuple[float, float, float]:
+        scoring = self.config["scoring"]
+        return scoring["latency"], scoring["loss"], scoring["jitter"]
+
+    def measure_candidates(self, candidates: List[Tuple[str, int]], samples: int):
+        matrix = np.full((len(candidates), samples), np.nan, dtype=np.float32)
+        rows = {}
+        for row, (ip, port) in enumerate(candidates):
+            if ':' in ip:
+                ip = socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, ip))
+            rows[(ip, port)] = row
+        engine = self._scan_engine()
+        with self.metrics.phase("measure"), self.progress("Measuring candidates...", samples) as advance:
+            # One round per sample column keeps at most one probe per target in flight,
+            # which is what reply matching by (ip, port) requires.
+            for column in range(samples):
+                def on_probe(ip, port, sent_at, rtt, err, column=column):
+                    if rtt is not None:
+                        matrix[rows[(ip, port)], column] = rtt
+
+                self.probes_sent += engine.scan(rows, self.trace.tap(on_probe, "measure") if self.trace else on_probe)
+                advance()
+        if self.trace:
+            self.trace.flush()
+        return matrix
+
+    def _score_matrix(self, matrix):
+        scoring = self.config["scoring"]
+        with self.metrics.phase("scoring"):
+            stats = probe_stats(matrix, scoring["percentile"])
+            latency = stats["percentile"] if scoring["latency_metric"] == "percentile" else stats["mean"]
+            return score_arrays(latency, stats["loss"], stats["jitter"], self.score_weights), latency, stats
+
+    def rank_candidates(self, candidates: List[Tuple[str, int]], measure: Optional[Callable] = None) -> List[ScanResult]:
+        if not candidates:
+            return []
+        scan_cfg = self.config["scan"]
+        measure = measure or self.measure_candidates
+        if scan_cfg["strategy"] == "halving":
+            halving = SuccessiveHalving(scan_cfg["top_n"], scan_cfg["samples"], scan_cfg["halving_eta"])
+            rows, matrix = halving.run(candidates, measure, lambda m: self._score_matrix(m)[0])
+            candidates = [candidates[i] for i in rows]
+            report = self.metrics.strategy_report = halving.report
+            self.console.print(f"[cyan]🎯 Successive halving: {report['probes']} probes in {report['rounds']} rounds, "
+                               f"saved {report['probes_saved']} of {report['exhaustive_probes']}.[/cyan]")
+        else:
+            matrix = measure(candidates, scan_cfg["samples"])
+        scores, latency, stats = self._score_matrix(matrix)
+        order = np.argsort(-scores, kind="stable")[:scan_cfg["top_n"]]
+        return [
+            ScanResult(ip=candidates[i][0], port=candidates[i][1], latency=float(latency[i]),
+                       packet_loss=float(stats["loss"][i]), jitter=float(stats["jitter"][i]), score=float(scores[i]))
+            for i in order if stats["received"][i]
+        ]
+
+    def replay_trace(self, path: str) -> List[ScanResult]:
+        """Re-run candidate selection, scoring and ranking over a recorded probe trace.
+
+        Discovery replies are scored and cut to the candidate list in one vectorised pass (the
+        best reply per target wins when a trace holds several runs); measurement then replays
+        the recorded samples through ``rank_candidates`` under the current scan and scoring config.
+        """
+        records = ProbeTrace.load(path)
+        scan_cfg = self.config["scan"]
+        multi_sample = scan_cfg["samples"] > 1
+        with self.metrics.phase("replay"):
+            rtt = records["rtt"]
+            found = np.flatnonzero((records["phase"] == TRACE_PHASES.index("discover")) & ~np.isnan(rtt))
+            scores = score_arrays(rtt[found].astype(np.float64), 0.0, 0.0, self.score_weights)
+            ranked = found[np.argsort(-scores, kind="stable")]
+            keys = ProbeTrace.keys(records)
+            _, first = np.unique(keys[ranked], return_index=True)
+            chosen = ranked[np.sort(first)][:scan_cfg["top_n"] * (CANDIDATE_FACTOR if multi_sample else 1)]
+            candidates = [(ProbeTrace.address(ip), int(port)) for ip, port in zip(records["ip"][chosen], records["port"][chosen])]
+        self.console.print(f"[cyan]📼 Replaying {len(records)} probe records: {len(found)} replies, {len(candidates)} candidates.[/cyan]")
+        if not multi_sample:
+            return [ScanResult(ip=ip, port=port, latency=float(rtt[i]), packet_loss=0.0, jitter=0.0,
+                               score=score_endpoint(float(rtt[i]), 0.0, 0.0, self.score_weights))
+                    for (ip, port), i in zip(candidates, chosen)]
+        replay = TraceReplay(records, candidates, keys[chosen])
+        results = self.rank_candidates(candidates, replay.measure)
+        if replay.missing:
+            self.console.print(f"[yellow]⚠️ {replay.missing} samples were not in the trace and count as lost; "
+                               f"record with at least the same samples and strategy to compare like for like.[/yellow]")
+        return results
+
+    @staticmethod
+    def _local_network(ip: str) -> str:
+        # The source address the kernel picks for this endpoint identifies the network we are on.
+        family = socket.AF_INET6 if ':' in ip else socket.AF_INET
         try:
-            family = socket.AF_INET6 if ':' in ip else socket.AF_INET
             with socket.socket(family, socket.SOCK_DGRAM) as sock:
-                sock.settimeout(self.port_scan_timeout)
-                start_time = time.monotonic()
-                sock.connect((ip, port))
-                sock.send(b'\x01')
-                sock.recv(1)
-                latency = (time.monotonic() - start_time) * 1000
-                jitter = random.uniform(0.1, 2.0)
-                return latency, 0.0, jitter
-        except (socket.timeout, ConnectionRefusedError, OSError):
-            return None
+                sock.connect((ip, 9))
+                return sock.getsockname()[0]
+        except OSError:
+            return "unknown"
 
-    def _deep_scan_ports(self, ips: List[str]) -> List[ScanResult]:
-        results = []
-        total_tasks = len(ips) * len(WARP_PORTS)
-        with Progress(TextColumn("[cyan]Scanning ports...[/cyan]"), BarColumn(), "[progress.percentage]{task.percentage:>3.0f}%", TimeRemainingColumn(), transient=True) as progress:
-            task = progress.add_task("", total=total_tasks)
-            with ThreadPoolExecutor(max_workers=self.config["scan"]["max_threads"]) as executor:
-                futures = {executor.submit(self._test_port_connection, ip, port): (ip, port) for ip in ips for port in WARP_PORTS}
-                for future in as_completed(futures):
-                    progress.update(task, advance=1)
-                    ip, port = futures[future]
-                    result = future.result()
-                    if result:
-                        latency, loss, jitter = result
-                        results.append(ScanResult(ip=ip, port=port, latency=latency, packet_loss=loss, jitter=jitter))
+    def discover_mtu(self, results: List[ScanResult]) -> List[ScanResult]:
+        mtu_cfg = self.config["mtu"]
+        if not mtu_cfg["enabled"] or not results:
+            return results
+        if mtu_cfg["probe"] == "icmp":
+            # WARP peers ignore anything but a valid handshake, so measure the path with ICMP echo
+            # instead; these hosts answered ping in stage 1.
+            reason = ICMPEchoEngine.open_error()
+            if reason:
+                self.console.print(f"[yellow]⚠️ MTU discovery skipped, cannot open an ICMP socket ({reason}); keeping the configured MTU.[/yellow]")
+                return results
+        elif self.config["scan"]["probe"] == "handshake":
+            # WireGuard drops padded initiations, so there is nothing to measure against.
+            self.console.print("[yellow]⚠️ MTU discovery needs the ping probe; keeping the configured MTU.[/yellow]")
+            return results
+        history = self.history
+        pending, payloads = {}, {}
+        for result in results:
+            ip = socket.inet_ntop(socket.AF_INET6, socket.inet_pton(socket.AF_INET6, result.ip)) if ':' in result.ip else result.ip
+            key = (self._local_network(ip), ip, result.port)
+            cached = history.cached_mtu(*key, mtu_cfg["cache_ttl"]) if history else self._mtu_cache.get(key)
+            if cached is not None:
+                payloads[id(result)] = cached
+            else:
+                pending.setdefault((ip, result.port), []).append((result, key))
+        if pending:
+            # Every round waits for its slowest probe, so bound the timeout by the RTTs just measured.
+            slowest = max((r.latency for group in pending.values() for r, _ in group if math.isfinite(r.latency)),
+                          default=mtu_cfg["timeout"] * 1000)
+            timeout = min(mtu_cfg["timeout"], max(0.1, slowest * 3 / 1000))
+            if mtu_cfg["probe"] == "icmp":
+                engine = ICMPEchoEngine(timeout=timeout)
+            else:
+                engine = UDPScanEngine(timeout=timeout, max_inflight=len(pending), sockets_per_family=1,
+                                       metrics=self.metrics, dont_fragment=True)
+            prober = PathMTUProber(engine, mtu_cfg["min_payload"], mtu_cfg["max_payload"], mtu_cfg["granularity"], mtu_cfg["tries"])
+            self.console.print(f"[cyan]📏 Discovering path MTU for {len(pending)} endpoints...[/cyan]")
+            with self.metrics.phase("mtu_discovery"):
+                found = prober.run(pending)
+            self.probes_sent += prober.probes
+            for endpoint, payload in found.items():
+                if payload is None:
+                    continue
+                for result, key in pending[endpoint]:
+                    payloads[id(result)] = payload
+                    if history:
+                        history.store_mtu(*key, payload)
+                    else:
+                        self._mtu_cache[key] = payload
+        for result in results:
+            if id(result) in payloads:
+                result.mtu = payloads[id(result)] - WG_TRANSPORT_OVERHEAD
         return results
 
-    def find_best_servers(self, ipv6=False) -> List[ScanResult]:
+    def find_best_servers(self, ipv6=False, ports: Optional[List[int]] = None) -> List[ScanResult]:
+        if self.config["scan"]["mode"] == "ranges" and not ipv6:
+            self.console.print("\n[bold magenta]🔬 Starting CIDR range sweep...[/bold magenta]")
+            results = self.scan_ranges(ports=ports)
+            if not results:
+                self.console.print("[red]❌ No viable ports found.[/red]")
+            return self.discover_mtu(results)
+        if self.config["scan"]["pipeline"]:
+            self.console.print("\n[bold magenta]🔬 Starting pipelined 2-stage endpoint scan...[/bold magenta]")
+            return self.discover_mtu(self._pipelined_scan(ipv6, ports))
         self.console.print("\n[bold magenta]🔬 Starting advanced 2-stage endpoint scan...[/bold magenta]")
         active_hosts = self._filter_active_endpoints(ipv6)
         if not active_hosts:
-            self.console.print("[red]� bazen None
-            self.console.print("[green]✅ Found {} active endpoints.[/green]".format(len(active_hosts)))
-            top_hosts = [ip for ip, _ in sorted(active_hosts, key=lambda x: x[1])[:30]]
-            results = self._deep_scan_ports(top_hosts)
-            if not results:
-                self.console.print("[red]❌ No viable ports found.[/red]")
-                return []
+            self.console.print("[red]❌ No active endpoints found.[/red]")
+            return []
+        self.console.print("[green]✅ Found {} active endpoints.[/green]".format(len(active_hosts)))
+        top_hosts = [ip for ip, _ in sorted(active_hosts, key=lambda x: x[1])[:DEEP_SCAN_HOSTS]]
+        results = self._deep_scan_ports(top_hosts, ports)
+        if not results:
+            self.console.print("[red]❌ No viable ports found.[/red]")
+            return []
+        if self.config["scan"]["samples"] > 1:
+            return self.discover_mtu(self.rank_candidates([(result.ip, result.port) for result in results]))
+        with self.metrics.phase("scoring"):
             for result in results:
-                score = ((1000 - result.latency) * 0.6 + (100 - result.packet_loss) * 0.3 + (10 - result.jitter) * 0.1)
-                result.score = max(0, score)
-            return sorted(results, key=lambda x: x.score, reverse=True)[:10]
+                result.score = score_endpoint(result.latency, result.packet_loss, result.jitter, self.score_weights)
+            results = sorted(results, key=lambda x: x.score, reverse=True)[:self.config["scan"]["top_n"]]
+        return self.discover_mtu(results)
 
-    def display_results_table(self, results: List[ScanResult]):
-        table = Table(title=f"[bold magenta]🏆 WarpFusion Elite Pro v{VERSION} - Top Servers[/bold magenta]", show_header=True)
+    def _results_table(self, results: List[ScanResult], title: str):
+        from rich.table import Table
+        table = Table(title=title, show_header=True)
         table.add_column("Rank", style="cyan", justify="center")
         table.add_column("IP", style="white")
         table.add_column("Port", style="green", justify="center")
         table.add_column("Latency (ms)", style="yellow", justify="right")
         table.add_column("Jitter (ms)", justify="right")
+        table.add_column("Loss (%)", justify="right")
         table.add_column("Score", style="bold green", justify="right")
         for i, result in enumerate(results[:10], 1):
             table.add_row(
                 f"#{i}", result.ip, str(result.port), f"{result.latency:.2f}",
-                f"{result.jitter:.2f}", f"{result.score:.2f}"
+                f"{result.jitter:.2f}", f"{result.packet_loss:.0f}", f"{result.score:.2f}"
             )
-        self.console.print(table)
+        return table
 
-    def generate_wg_config(self, warp_key: WarpKey, result: ScanResult, format_type="wg") -> str:
+    def display_results_table(self, results: List[ScanResult]):
+        self.console.print(self._results_table(results, f"[bold magenta]🏆 WarpFusion Elite Pro v{VERSION} - Top Servers[/bold magenta]"))
+
+    def generate_wg_config(self, warp_key: WarpKey, result: ScanResult, format_type="wg",
+                           reserved: Optional[List[int]] = None) -> str:
+        mtu = result.mtu or self.config['wireguard']['mtu']
         if format_type == "wg":
             return f"""
 # WarpFusion Elite Pro v{VERSION} - WireGuard Config
@@ -392,7 +2948,7 @@ class WarpFusionElitePro:
 PrivateKey = {warp_key.private_key}
 Address = {warp_key.address_v4}, {warp_key.address_v6}
 DNS = {', '.join(self.config['core']['dns']['servers'])}
-MTU = {self.config['wireguard']['mtu']}
+MTU = {mtu}
 
 [Peer]
 PublicKey = {warp_key.public_key}
@@ -400,73 +2956,119 @@ AllowedIPs = 0.0.0.0/0, ::/0
 Endpoint = {result.ip}:{result.port}
 PersistentKeepalive = {self.config['wireguard']['keepalive']}
 """
-        elif format_type == "sing-box":
-            reserved = base64.b64decode(warp_key.client_id)
-            reserved_str = ','.join(str(b) for b in reserved)
-            return f"""
-{{
-  "outbounds": [
-    {{
-      "type": "wireguard",
-      "tag": "WarpFusion-WireGuard",
-      "local_address": ["{warp_key.address_v4}", "{warp_key.address_v6}"],
-      "private_key": "{warp_key.private_key}",
-      "server": "{result.ip}",
-      "server_port": {result.port},
-      "peer_public_key": "{warp_key.public_key}",
-      "reserved": [{reserved_str}],
-      "mtu": {self.config['wireguard']['mtu']}
-    }}
-  ]
-}}
-"""
+        if reserved is None:
+            reserved = list(base64.b64decode(warp_key.client_id))
+        addresses = [warp_key.address_v4, warp_key.address_v6]
+        if format_type == "sing-box":
+            outbound = {
+                "type": "wireguard",
+                "tag": "WarpFusion-WireGuard",
+                "local_address": addresses,
+                "private_key": warp_key.private_key,
+                "server": result.ip,
+                "server_port": result.port,
+                "peer_public_key": warp_key.public_key,
+                "reserved": reserved,
+                "mtu": mtu
+            }
         elif format_type == "v2ray":
-            reserved = base64.b64decode(warp_key.client_id)
-            reserved_str = json.dumps([int(b) for b in reserved])
-            return f"""
-{{
-  "outbounds": [
-    {{
-      "protocol": "wireguard",
-      "settings": {{
-        "address": ["{warp_key.address_v4}", "{warp_key.address_v6}"],
-        "mtu": {self.config['wireguard']['mtu']},
-        "peers": [
-          {{
-            "endpoint": "{result.ip}:{result.port}",
-            "publicKey": "{warp_key.public_key}"
-          }}
-        ],
-        "reserved": {reserved_str},
-        "secretKey": "{warp_key.private_key}"
-      }},
-      "tag": "WarpFusion-V2Ray"
-    }}
-  ]
-}}
-"""
+            outbound = {
+                "protocol": "wireguard",
+                "settings": {
+                    "address": addresses,
+                    "mtu": mtu,
+                    "peers": [{"endpoint": f"{result.ip}:{result.port}", "publicKey": warp_key.public_key}],
+                    "reserved": reserved,
+                    "secretKey": warp_key.private_key
+                },
+                "tag": "WarpFusion-V2Ray"
+            }
+        else:
+            raise ValueError(f"unknown config format: {format_type}")
+        return json.dumps({"outbounds": [outbound]}, indent=2)
+
+    def share_link(self, warp_key: WarpKey, result: ScanResult, reserved: Optional[List[int]] = None, name: str = "") -> str:
+        """``wireguard://`` URI as imported by sing-box and v2rayN-style clients from a subscription."""
+        if reserved is None:
+            reserved = list(base64.b64decode(warp_key.client_id))
+        host = f"[{result.ip}]" if ':' in result.ip else result.ip
+        query = urllib.parse.urlencode({
+            "publickey": warp_key.public_key,
+            "address": f"{warp_key.address_v4},{warp_key.address_v6}",
+            "reserved": ",".join(map(str, reserved)),
+            "mtu": result.mtu or self.config["wireguard"]["mtu"]
+        }, safe=",:")
+        return f"wireguard://{urllib.parse.quote(warp_key.private_key, safe='')}@{host}:{result.port}?{query}#{urllib.parse.quote(name)}"
+
+    @staticmethod
+    def config_filename(format_type: str, index: int) -> str:
+        ext = "conf" if format_type == "wg" else "json"
+        return f"{WARP_CONF_PREFIX}_{format_type}_{index}.{ext}"
+
+    def save_config(self, warp_key: WarpKey, result: ScanResult, format_type="wg", index: int = 1) -> Tuple[str, str]:
+        config_str = self.generate_wg_config(warp_key, result, format_type)
+        path = os.path.join(WARP_CONF_DIR, self.config_filename(format_type, index))
+        write_atomic(path, config_str.strip())
+        return path, config_str
 
     def generate_and_save_configs(self, warp_key: WarpKey, results: List[ScanResult], format_type="wg"):
+        from rich.panel import Panel
         self.console.print("\n[bold]📄 Generating configuration files...[/bold]")
-        os.makedirs(WARP_CONF_DIR, exist_ok=True)
-        for i, result in enumerate(results[:3], 1):
-            config_str = self.generate_wg_config(warp_key, result, format_type)
-            ext = "conf" if format_type == "wg" else "json"
-            filename = f"{WARP_CONF_PREFIX}_{format_type}_{i}.{ext}"
-            path = os.path.join(WARP_CONF_DIR, filename)
-            try:
-                with open(path, 'w', encoding='utf-8') as f:
-                    f.write(config_str.strip())
-                self.console.print(Panel(
-                    config_str.strip(),
-                    title=f"[bold green]Config #{i} ({filename})[/bold green]",
-                    subtitle=f"[yellow]Saved to: {path}[/yellow]",
-                    border_style="green"
-                ))
-            except Exception as e:
-                self.console.print(f"[red]❌ Failed to save config {filename}: {e}[/red]")
+        with self.metrics.phase("config_generation"):
+            for i, result in enumerate(results[:3], 1):
+                filename = self.config_filename(format_type, i)
+                try:
+                    path, config_str = self.save_config(warp_key, result, format_type, i)
+                    self.console.print(Panel(
+                        config_str.strip(),
+                        title=f"[bold green]Config #{i} ({filename})[/bold green]",
+                        subtitle=f"[yellow]Saved to: {path}[/yellow]",
+                        border_style="green"
+                    ))
+                except Exception as e:
+                    self.console.print(f"[red]❌ Failed to save config {filename}: {e}[/red]")
+
+    def export_fleet(self, keys: List[WarpKey], results: List[ScanResult], formats: Optional[List[str]] = None,
+                     out_dir: Optional[str] = None, per_key: Optional[int] = None, bundle: Optional[str] = None,
+                     workers: Optional[int] = None) -> List[Dict]:
+        """Write every format for every key's endpoint assignment in one pass, without console output.
+
+        Key ``i`` gets ``per_key`` endpoints starting at rank ``i mod len(results)``, so a fleet
+        spreads over the ranked list instead of piling onto the top endpoint. Each key's client id
+        is decoded once. Files go to ``out_dir/key_NNNN/`` and are written atomically (mode 0600)
+        from a thread pool, followed by ``manifest.json``; ``bundle`` also writes a single base64
+        subscription of ``wireguard://`` links. Returns the manifest entries.
+        """
+        export_cfg = self.config["export"]
+        formats = formats or export_cfg["formats"]
+        out_dir = out_dir or export_cfg["dir"]
+        per_key = min(per_key or export_cfg["per_key"], len(results))
+        jobs, manifest, links = [], [], []
+        with self.metrics.phase("config_generation"):
+            for i, warp_key in enumerate(keys):
+                reserved = list(base64.b64decode(warp_key.client_id))
+                device = f"key_{i + 1:04d}"
+                for slot in range(per_key):
+                    rank = (i + slot) % len(results)
+                    result = results[rank]
+                    for format_type in formats:
+                        path = os.path.join(out_dir, device, self.config_filename(format_type, slot + 1))
+                        jobs.append((path, self.generate_wg_config(warp_key, result, format_type, reserved).strip()))
+                        manifest.append({"key": device, "rank": rank + 1,
+                                         "ip": result.ip, "port": result.port, "format": format_type, "path": path})
+                    if bundle:
+                        links.append(self.share_link(warp_key, result, reserved, f"{device}-{slot + 1}"))
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers or export_cfg["workers"]) as pool:
+                for future in [pool.submit(write_atomic, path, text, 0o600) for path, text in jobs]:
+                    future.result()
+            write_atomic(os.path.join(out_dir, "manifest.json"), json.dumps(manifest, indent=2))
+            if bundle:
+                write_atomic(bundle, base64.b64encode("\n".join(links).encode()).decode(), mode=0o600)
+        return manifest
 
     def display_usage_guide(self, format_type="wg"):
+        from rich.markdown import Markdown
         guide = Markdown(f"""
 ### 📖 WarpFusion Elite Pro Usage Guide ({format_type.upper()})
 
@@ -476,3 +3078,853 @@ Your configurations are ready! Follow these steps:
 ```bash
 sudo wg-quick up ./{WARP_CONF_DIR}/{WARP_CONF_PREFIX}_wg_1.conf
 sudo wg-quick down ./{WARP_CONF_DIR}/{WARP_CONF_PREFIX}_wg_1.conf
+```
+
+#### For Sing-box / V2Ray:
+Import the generated JSON file from `./{WARP_CONF_DIR}/` into your client's outbounds.
+
+#### Tips:
+- Re-run the scanner periodically to pick up faster endpoints.
+- Keep `{CONFIG_FILE}` private; it contains your Warp private key.
+""")
+        self.console.print(guide)
+
+    def run(self):
+        from rich.prompt import Prompt
+        self.print_banner()
+        self.run_initial_checks()
+        self.optimize_system()
+        self.detect_network_quality()
+        warp_key = self.load_or_create_key()
+        format_type = Prompt.ask("Select config format", choices=["wg", "sing-box", "v2ray"], default="wg")
+        ipv6 = Prompt.ask("Scan IPv6 endpoints?", choices=["y", "n"], default="n") == "y"
+        self.open_trace()
+        try:
+            results = self.find_best_servers(ipv6)
+        finally:
+            self.close_trace()
+        if not results:
+            sys.exit(1)
+        self.display_results_table(results)
+        self.generate_and_save_configs(warp_key, results, format_type)
+        self.display_usage_guide(format_type)
+        self.export_metrics()
+
+# --- Endpoint Monitor ---
+class EndpointMonitor:
+    """Keeps the active endpoint healthy by probing it and a warm standby set on a fixed interval.
+
+    Each round sends ``samples`` probes to every tracked endpoint, so the packet budget is
+    ``(1 + standby) * samples / interval`` per second. Latency, jitter and loss are judged over
+    the last ``window`` rounds; an endpoint that misses every probe of a round, or whose window
+    exceeds ``max_latency``/``max_loss``, takes a strike. After ``fail_after`` consecutive strikes
+    the active endpoint is swapped for the best healthy standby, the configs are rewritten
+    atomically and ``reload_command`` runs. Standbys that fail are dropped; a full rescan refills
+    the pool at most once per ``rescan_interval`` seconds.
+    """
+
+    def __init__(self, app: "WarpFusionElitePro", warp_key: WarpKey, format_type: str = "wg",
+                 on_event: Optional[Callable[[Dict], None]] = None, interval: float = 5.0, samples: int = 3,
+                 window: int = 4, standby: int = 4, timeout: float = 1.0, max_latency: float = 300,
+                 max_loss: float = 30, fail_after: int = 2, rescan_interval: float = 900, reload_command: str = ""):
+        self.app = app
+        self.warp_key = warp_key
+        self.format_type = format_type
+        self.on_event = on_event or (lambda event: None)
+        self.interval = interval
+        self.samples = samples
+        self.window = window * samples
+        self.standby_size = standby
+        self.timeout = timeout
+        self.max_latency = max_latency
+        self.max_loss = max_loss
+        self.fail_after = fail_after
+        self.rescan_interval = rescan_interval
+        self.reload_command = reload_command
+        self.endpoints: List[ScanResult] = []
+        self.history: Dict[Tuple[str, int], deque] = {}
+        self.strikes: Dict[Tuple[str, int], int] = {}
+        self.last_rescan = 0.0
+        self.failovers = 0
+
+    @property
+    def active(self) -> Optional[ScanResult]:
+        return self.endpoints[0] if self.endpoints else None
+
+    def seed(self, results: List[ScanResult]):
+        tracked = {(r.ip, r.port) for r in self.endpoints}
+        self.endpoints = (self.endpoints + [r for r in results if (r.ip, r.port) not in tracked])[:1 + self.standby_size]
+        keys = [(r.ip, r.port) for r in self.endpoints]
+        self.history = {key: self.history.get(key) or deque(maxlen=self.window) for key in keys}
+        self.strikes = {key: self.strikes.get(key, 0) for key in keys}
+        self.last_rescan = time.monotonic()
+
+    def apply(self, reason: str):
+        paths = []
+        for i, result in enumerate(self.endpoints[:3], 1):
+            path, _ = self.app.save_config(self.warp_key, result, self.format_type, i)
+            paths.append(path)
+        event = {"event": "config", "reason": reason, "endpoint": f"{self.active.ip}:{self.active.port}", "paths": paths}
+        if self.reload_command:
+            command = self.reload_command.replace("{config}", shlex.quote(os.path.abspath(paths[0])))
+            try:
+                event["reload_status"] = subprocess.run(command, shell=True, timeout=60, stdout=sys.stderr).returncode
+            except subprocess.TimeoutExpired:
+                event["reload_status"] = None
+        self.on_event(event)
+
+    def _healthy(self, result: ScanResult, round_received: int) -> bool:
+        return round_received > 0 and result.latency <= self.max_latency and result.packet_loss <= self.max_loss
+
+    def step(self) -> Dict:
+        candidates = [(r.ip, r.port) for r in self.endpoints]
+        self.app.port_scan_timeout = self.timeout
+        matrix = self.app.measure_candidates(candidates, self.samples)
+        healthy = []
+        for row, result in enumerate(self.endpoints):
+            key = (result.ip, result.port)
+            samples = self.history[key]
+            samples.extend(float(v) for v in matrix[row])
+            scores, latency, stats = self.app._score_matrix(np.array(samples, dtype=np.float32)[None, :])
+            result.latency, result.jitter = float(latency[0]), float(stats["jitter"][0])
+            result.packet_loss, result.score = float(stats["loss"][0]), float(scores[0])
+            ok = self._healthy(result, int((~np.isnan(matrix[row])).sum()))
+            self.strikes[key] = 0 if ok else self.strikes[key] + 1
+            healthy.append(ok)
+        active = self.active
+        event = {"event": "health", "endpoint": f"{active.ip}:{active.port}", "latency": round(active.latency, 2),
+                 "packet_loss": round(active.packet_loss, 1), "jitter": round(active.jitter, 2),
+                 "strikes": self.strikes[(active.ip, active.port)], "standby_healthy": sum(healthy[1:]),
+                 "probes": len(candidates) * self.samples}
+        self.on_event(event)
+        if self.strikes[(active.ip, active.port)] >= self.fail_after:
+            self.failover()
+        standby = [r for r in self.endpoints[1:] if self.strikes[(r.ip, r.port)] < self.fail_after]
+        self.endpoints = self.endpoints[:1] + standby
+        if (len(standby) < max(1, self.standby_size // 2)
+                and time.monotonic() - self.last_rescan >= self.rescan_interval):
+            self.rescan()
+        return event
+
+    def failover(self):
+        old = self.active
+        standby = sorted((r for r in self.endpoints[1:] if self.strikes[(r.ip, r.port)] == 0),
+                         key=lambda r: r.score, reverse=True)
+        if not standby:
+            self.app.console.print(f"[red]❌ {old.ip}:{old.port} is degraded and no standby is healthy.[/red]")
+            self.on_event({"event": "degraded", "endpoint": f"{old.ip}:{old.port}"})
+            if time.monotonic() - self.last_rescan >= self.rescan_interval:
+                self.rescan()
+            return
+        new = standby[0]
+        self.endpoints = [new] + [r for r in self.endpoints[1:] if r is not new]
+        self.failovers += 1
+        self.app.console.print(f"[yellow]🔁 Failover {old.ip}:{old.port} → {new.ip}:{new.port} "
+                               f"({old.latency:.0f}ms, {old.packet_loss:.0f}% loss)[/yellow]")
+        self.on_event({"event": "failover", "from": f"{old.ip}:{old.port}", "to": f"{new.ip}:{new.port}",
+                       "latency": round(old.latency, 2), "packet_loss": round(old.packet_loss, 1)})
+        self.apply("failover")
+
+    def rescan(self):
+        self.app.console.print("[cyan]📡 Standby pool depleted, rescanning...[/cyan]")
+        self.seed(self.app.find_best_servers())
+        self.on_event({"event": "rescan", "standby": len(self.endpoints) - 1})
+
+    def run(self, stop: threading.Event):
+        next_round = time.monotonic()
+        while not stop.is_set():
+            self.step()
+            next_round += self.interval
+            stop.wait(max(0.0, next_round - time.monotonic()))
+            next_round = max(next_round, time.monotonic() - self.interval)
+
+# --- Benchmark Harness ---
+@dataclass
+class FarmEndpoint:
+    ip: str
+    ports: List[int]
+    latency: float
+    jitter: float
+    loss: float
+    mtu: Optional[int] = None
+
+
+@dataclass
+class FarmHost:
+    """The parts of icmplib's Host that stage 1 reads, as returned by SimulatedFarm's pings."""
+    address: str
+    packets_sent: int
+    rtts: List[float]
+
+    @property
+    def is_alive(self) -> bool:
+        return bool(self.rtts)
+
+    @property
+    def avg_rtt(self) -> float:
+        return sum(self.rtts) / len(self.rtts) if self.rtts else 0.0
+
+
+class SimulatedFarm:
+    """Loopback WARP stand-ins with per-endpoint latency, jitter, loss and dead ports.
+
+    Responders run in a child process so the scanner's CPU time and peak RSS are measured on
+    their own. Each live (ip, port) gets its own socket on a 127.0.0.0/8 address; dead ports
+    have no socket and never answer. An endpoint with an ``mtu`` silently drops datagrams that
+    would not fit a path of that MTU, like a router honouring DF. With a ``handshake_key`` every
+    endpoint is a WireGuardResponder for that static key instead of an echo, including its
+    replay protection, so handshake probing can be benchmarked offline. ``async_ping`` and
+    ``multiping`` mirror icmplib with the same latency, jitter and loss (hosts without live
+    ports still answer), so the farm can stand in as the scanner's ICMP stage 1.
+    """
+
+    def __init__(self, endpoints: List[FarmEndpoint], seed: int = 0, handshake_key: Optional[bytes] = None):
+        self.endpoints = endpoints
+        self.seed = seed
+        self.handshake_key = handshake_key
+        self._process: Optional[multiprocessing.Process] = None
+        self._stop = None
+        self._by_ip = {endpoint.ip: endpoint for endpoint in endpoints}
+        self._icmp_rng = random.Random(seed + 1)
+
+    @classmethod
+    def generate(cls, hosts: int, ports: List[int], alive_ports: int, seed: int = 0, dead_hosts: float = 0.2,
+                 latency: Tuple[float, float] = (10, 250), jitter: Tuple[float, float] = (0, 15),
+                 loss: Tuple[float, float] = (0, 0.3), network: str = BENCH_NETWORK,
+                 mtu: Optional[Tuple[int, int]] = None, handshake_key: Optional[bytes] = None) -> "SimulatedFarm":
+        rng = random.Random(seed)
+        base = int(ipaddress.ip_network(network).network_address)
+        endpoints = []
+        for i in range(hosts):
+            live = [] if rng.random() < dead_hosts else sorted(rng.sample(ports, min(alive_ports, len(ports))))
+            endpoints.append(FarmEndpoint(
+                ip=str(ipaddress.IPv4Address(base + 1 + i)), ports=live, latency=rng.uniform(*latency),
+                jitter=rng.uniform(*jitter), loss=rng.choice([0.0, 0.0, rng.uniform(*loss)]),
+                mtu=rng.randint(*mtu) if mtu else None
+            ))
+        return cls(endpoints, seed, handshake_key)
+
+    def ground_truth(self, top_k: int, weights: Tuple[float, float, float] = SCORE_WEIGHTS) -> List[Tuple[str, int]]:
+        # Expected scores: E|X - Y| = 2σ/√π for consecutive Gaussian delays.
+        scored = [(score_endpoint(e.latency, e.loss * 100, 2 * e.jitter / math.sqrt(math.pi), weights), e.ip, port)
+                  for e in self.endpoints for port in e.ports]
+        return [(ip, port) for _, ip, port in sorted(scored, reverse=True)[:top_k]]
+
+    async def async_ping(self, address: str, count: int = 4, interval: float = 1, timeout: float = 2,
+                         **kwargs) -> FarmHost:
+        endpoint = self._by_ip.get(address)
+        rtts = []
+        for sequence in range(count):
+            if sequence:
+                await asyncio.sleep(interval)
+            rtt = None
+            if endpoint is not None and self._icmp_rng.random() >= endpoint.loss:
+                rtt = max(0.0, self._icmp_rng.gauss(endpoint.latency, endpoint.jitter))
+            if rtt is None or rtt / 1000 > timeout:
+                await asyncio.sleep(timeout)
+            else:
+                await asyncio.sleep(rtt / 1000)
+                rtts.append(rtt)
+        return FarmHost(address, count, rtts)
+
+    def multiping(self, addresses: List[str], count: int = 2, interval: float = 0.5, timeout: float = 2,
+                  **kwargs) -> List[FarmHost]:
+        async def run():
+            return await asyncio.gather(*(self.async_ping(address, count, interval, timeout) for address in addresses))
+
+        return asyncio.run(run())
+
+    def _serve(self, ready, stop):
+        rng = random.Random(self.seed)
+        responders = ({endpoint.ip: WireGuardResponder(self.handshake_key, host=None) for endpoint in self.endpoints}
+                      if self.handshake_key else {})
+        selector = selectors.DefaultSelector()
+        for endpoint in self.endpoints:
+            for port in endpoint.ports:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, ENGINE_RCVBUF)
+                sock.bind((endpoint.ip, port))
+                sock.setblocking(False)
+                selector.register(sock, selectors.EVENT_READ, endpoint)
+        ready.set()
+        pending: List[Tuple[float, int, socket.socket, bytes, Tuple]] = []
+        seq = 0
+        while not stop.is_set():
+            wait = max(0.0, pending[0][0] - time.monotonic()) if pending else 0.1
+            for key, _ in selector.select(min(wait, 0.1)):
+                endpoint = key.data
+                while True:
+                    try:
+                        data, addr = key.fileobj.recvfrom(ENGINE_RECV_SIZE)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    if endpoint.mtu and len(data) + 28 > endpoint.mtu:
+                        continue
+                    if rng.random() < endpoint.loss:
+                        continue
+                    if responders:
+                        data = responders[endpoint.ip].respond(data)
+                        if data is None:
+                            continue
+                    delay = max(0.0, rng.gauss(endpoint.latency, endpoint.jitter)) / 1000
+                    seq += 1
+                    heapq.heappush(pending, (time.monotonic() + delay, seq, key.fileobj, data, addr))
+            now = time.monotonic()
+            while pending and pending[0][0] <= now:
+                _, _, sock, data, addr = heapq.heappop(pending)
+                try:
+                    sock.sendto(data, addr)
+                except OSError:
+                    pass
+
+    def start(self) -> "SimulatedFarm":
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+        ready, self._stop = context.Event(), context.Event()
+        self._process = context.Process(target=self._serve, args=(ready, self._stop), daemon=True)
+        self._process.start()
+        if not ready.wait(30):
+            self.stop()
+            raise RuntimeError("Simulated farm failed to start")
+        return self
+
+    def stop(self):
+        if self._process is not None:
+            self._stop.set()
+            self._process.join(5)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class MockWarpAPI:
+    """Local stand-in for CF_API: answers registrations like the real endpoint and enforces
+    its own token-bucket limit with 429 + Retry-After, so batch registration can be tested offline.
+    """
+
+    def __init__(self, rate_limit: float = 20.0, burst: int = 20, latency: float = 0.05,
+                 retry_after: int = 1, host: str = "127.0.0.1", port: int = 0):
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.latency = latency
+        self.retry_after = retry_after
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.requests = self.throttled = self.connections = 0
+        self.registered: Dict[str, dict] = {}
+        self.peer_public = base64.b64encode(os.urandom(32)).decode()
+        import http.server
+        self.server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{urllib.parse.urlsplit(CF_API).path}"
+
+    def _admit(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate_limit)
+            self.updated = now
+            self.requests += 1
+            if self.tokens < 1.0:
+                self.throttled += 1
+                return False
+            self.tokens -= 1.0
+            return True
+
+    def _register(self, key: str) -> dict:
+        with self.lock:
+            n = len(self.registered) + 1
+            config = {
+                "id": f"mock-{n}",
+                "config": {
+                    "client_id": base64.b64encode(os.urandom(3)).decode(),
+                    "peers": [{"public_key": self.peer_public,
+                               "endpoint": {"v4": "162.159.192.1:0", "v6": "[2606:4700:d0::a29f:c001]:0", "host": "engage.cloudflareclient.com:2408"}}],
+                    "interface": {"addresses": {"v4": f"172.16.{n // 256 % 256}.{n % 256}",
+                                                "v6": f"2606:4700:110:8a36::{n:x}"}}
+                }
+            }
+            self.registered[key] = config
+            return config
+
+    def _handler(self):
+        import http.server
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with api.lock:
+                    api.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, body: bytes = b"", headers: Optional[Dict[str, str]] = None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if not api._admit():
+                    self._reply(429, b"", {"Retry-After": str(api.retry_after)})
+                    return
+                time.sleep(api.latency)
+                try:
+                    key = json.loads(body)["key"]
+                except (ValueError, KeyError, TypeError):
+                    self._reply(400)
+                    return
+                self._reply(200, json.dumps(api._register(key)).encode(), {"Content-Type": "application/json"})
+
+        return Handler
+
+    def start(self) -> "MockWarpAPI":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def run_benchmark(app: "WarpFusionElitePro", farm: SimulatedFarm, mode: str = "endpoints",
+                  ports: Optional[List[int]] = None) -> Dict:
+    ports = ports or WARP_PORTS
+    top_k = app.config["scan"]["top_n"]
+    start_cpu, start_wall = time.process_time(), time.perf_counter()
+    start_worker_cpu = app.metrics.worker_cpu_s
+    app.probes_sent = 0
+    # The real entry point: ICMP stage 1 (pipelined or not) against the farm's simulated pings,
+    # or the CIDR sweep, then ranking and MTU discovery.
+    scan_cfg = app.config["scan"]
+    scan_cfg.update(mode=mode, endpoints=[e.ip for e in farm.endpoints], ranges=[f"{e.ip}/32" for e in farm.endpoints])
+    app.icmp = farm
+    app.config["mtu"]["enabled"] = any(e.mtu for e in farm.endpoints)
+    results = app.find_best_servers(ports=ports)
+    mtu_limits = {e.ip: e.mtu for e in farm.endpoints if e.mtu}
+    wall = time.perf_counter() - start_wall
+    # Forked scan workers report their own rusage; the parent's process time alone misses them.
+    cpu = time.process_time() - start_cpu + app.metrics.worker_cpu_s - start_worker_cpu
+    truth = farm.ground_truth(top_k, app.score_weights)
+    hits = len({(r.ip, r.port) for r in results[:top_k]} & set(truth))
+    report = {
+        "mode": mode, "pipeline": mode == "endpoints" and scan_cfg["pipeline"], "probe": app.config["scan"]["probe"], "strategy": app.config["scan"]["strategy"], "samples": app.config["scan"]["samples"],
+        "workers": app.scan_workers if mode == "ranges" else 1,
+        "targets": len(farm.endpoints) * len(ports), "live_targets": sum(len(e.ports) for e in farm.endpoints),
+        "probes": app.probes_sent, "wall_s": round(wall, 3), "cpu_s": round(cpu, 3),
+        "probes_per_sec": round(app.probes_sent / wall, 1) if wall else 0.0,
+        "peak_rss_kb": max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, app.metrics.worker_max_rss_kb),
+        "top_k": top_k, "precision_at_k": round(hits / max(1, min(top_k, len(truth))), 3),
+        "found": len(results)
+    }
+    if mtu_limits:
+        # Discovery is exact to within one search step of the largest payload that fits.
+        step = app.config["mtu"]["granularity"]
+        exact = [0 <= (mtu_limits[r.ip] - 28) - (r.mtu + WG_TRANSPORT_OVERHEAD) <= step for r in results if r.mtu]
+        report["mtu_found"] = len(exact)
+        report["mtu_accuracy"] = round(sum(exact) / max(1, len(results)), 3)
+    return report
+
+# --- Command Line ---
+def _json_safe(value):
+    # JSON has no inf/NaN; a dead endpoint's latency must come out as null, not "Infinity".
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: _json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_safe(item) for item in value]
+    return value
+
+def _emit(record: Dict):
+    sys.stdout.write(json.dumps(_json_safe(record), separators=(",", ":"), allow_nan=False) + "\n")
+    sys.stdout.flush()
+
+def cmd_interactive(args) -> int:
+    ensure_dependencies(DEPENDENCIES)
+    WarpFusionElitePro().run()
+    return EXIT_OK
+
+def cmd_scan(args) -> int:
+    needed = ["numpy"]
+    if not args.ranges and args.mode != "ranges":
+        needed.append("icmplib")
+    if args.probe == "handshake":
+        needed.append("cryptography")
+    if args.format == "table":
+        needed.append("rich")
+    packages = missing_dependencies(needed)
+    if packages:
+        sys.stderr.write(f"error: missing dependencies, install with: pip install {' '.join(packages)}\n")
+        return EXIT_ERROR
+    app = WarpFusionElitePro(headless=args.format != "table", quiet=args.quiet)
+    app.metrics.profile |= args.profile
+    app.metrics.trace_memory |= args.tracemalloc
+    scan_cfg = app.config["scan"]
+    if args.ranges:
+        scan_cfg["mode"], scan_cfg["ranges"] = "ranges", args.ranges
+    elif args.mode:
+        scan_cfg["mode"] = args.mode
+    for key in ("probe", "samples", "strategy", "top_n", "workers", "stable_for"):
+        if getattr(args, key) is not None:
+            scan_cfg[key] = getattr(args, key)
+    if args.timeout is not None:
+        app.port_scan_timeout = args.timeout
+    if args.no_history:
+        app.config["history"]["enabled"] = False
+    if not args.no_adaptive:
+        app.controller = app.create_controller(initial_timeout=args.timeout)
+    if scan_cfg["probe"] == "handshake":
+        app.load_or_create_key()
+    if args.format == "ndjson":
+        app.on_result = lambda result, stage: _emit({"stage": stage, **result.__dict__})
+    app.open_trace(args.record)
+    try:
+        results = app.find_best_servers(args.ipv6)
+    finally:
+        app.close_trace()
+    app.export_metrics(args.metrics_prom, args.metrics_json)
+    return _output_results(app, results, args.format)
+
+def _output_results(app: "WarpFusionElitePro", results: List[ScanResult], format_type: str) -> int:
+    if format_type == "ndjson":
+        for rank, result in enumerate(results, 1):
+            _emit({"stage": "ranked", "rank": rank, **result.__dict__})
+    elif format_type == "json":
+        _emit([{"rank": rank, **result.__dict__} for rank, result in enumerate(results, 1)])
+    else:
+        app.display_results_table(results)
+    return EXIT_OK if results else EXIT_NO_RESULTS
+
+def cmd_replay(args) -> int:
+    needed = ["numpy"] + (["rich"] if args.format == "table" else [])
+    packages = missing_dependencies(needed)
+    if packages:
+        sys.stderr.write(f"error: missing dependencies, install with: pip install {' '.join(packages)}\n")
+        return EXIT_ERROR
+    app = WarpFusionElitePro(headless=args.format != "table", quiet=args.quiet)
+    app.metrics.profile |= args.profile
+    app.metrics.trace_memory |= args.tracemalloc
+    scan_cfg, scoring = app.config["scan"], app.config["scoring"]
+    for key in ("samples", "strategy", "top_n"):
+        if getattr(args, key) is not None:
+            scan_cfg[key] = getattr(args, key)
+    if args.weights:
+        scoring["latency"], scoring["loss"], scoring["jitter"] = args.weights
+    if args.latency_metric:
+        scoring["latency_metric"] = args.latency_metric
+    if args.percentile is not None:
+        scoring["percentile"] = args.percentile
+    try:
+        results = app.replay_trace(args.trace)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"error: {e}\n")
+        return EXIT_ERROR
+    app.export_metrics(args.metrics_prom, args.metrics_json)
+    return _output_results(app, results, args.format)
+
+def cmd_monitor(args) -> int:
+    needed = ["numpy"] + (["icmplib"] if not args.ranges else []) + (["cryptography"] if args.probe == "handshake" else [])
+    packages = missing_dependencies(needed)
+    if packages:
+        sys.stderr.write(f"error: missing dependencies, install with: pip install {' '.join(packages)}\n")
+        return EXIT_ERROR
+    app = WarpFusionElitePro(headless=True, quiet=args.quiet)
+    app.metrics.profile |= args.profile
+    app.metrics.trace_memory |= args.tracemalloc
+    if args.ranges:
+        app.config["scan"]["mode"], app.config["scan"]["ranges"] = "ranges", args.ranges
+    app.config["scan"]["probe"] = args.probe
+    monitor_cfg = app.config["monitor"]
+    for key in ("interval", "standby", "max_latency", "max_loss", "reload_command"):
+        if getattr(args, key) is not None:
+            monitor_cfg[key] = getattr(args, key)
+    warp_key = app.load_or_create_key()
+    app.controller = app.create_controller()
+    results = app.find_best_servers()
+    if not results:
+        return EXIT_NO_RESULTS
+    # Steady-state rounds probe a handful of known endpoints; the AIMD controller only pays off on sweeps.
+    app.controller = None
+    metrics_cfg = app.config["metrics"]
+    prometheus_file = args.metrics_prom or metrics_cfg["prometheus_file"]
+
+    def on_event(event: Dict):
+        _emit({"time": round(time.time(), 3), **event})
+        if event["event"] == "health" and prometheus_file:
+            with contextlib.suppress(OSError):
+                app.metrics.write_prometheus(prometheus_file)
+
+    monitor = EndpointMonitor(app, warp_key, args.config_format, on_event, **monitor_cfg)
+    monitor.seed(results)
+    monitor.apply("initial")
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        monitor.run(stop)
+    except KeyboardInterrupt:
+        pass
+    app.export_metrics(args.metrics_prom, args.metrics_json)
+    return EXIT_OK
+
+def cmd_keys(args) -> int:
+    packages = missing_dependencies(["cryptography"])
+    if packages:
+        sys.stderr.write(f"error: missing dependencies, install with: pip install {' '.join(packages)}\n")
+        return EXIT_ERROR
+    app = WarpFusionElitePro(headless=True, quiet=args.quiet)
+    reg_cfg = app.config["registration"]
+    for key in ("workers", "rate", "burst", "api"):
+        if getattr(args, key) is not None:
+            reg_cfg[key] = getattr(args, key)
+    mock = None
+    if args.mock:
+        mock = MockWarpAPI(rate_limit=args.mock_rate, burst=int(args.mock_rate), latency=args.mock_latency).start()
+        reg_cfg["api"] = mock.url
+    try:
+        start = time.perf_counter()
+        keys, errors = app.create_warp_keys(args.count)
+        wall = time.perf_counter() - start
+        pool_size = app.save_key_pool(keys, args.output) if keys else 0
+    finally:
+        if mock is not None:
+            mock.stop()
+    registrar = app.registrar
+    _emit({
+        "registered": len(keys), "failed": len(errors), "pool_size": pool_size,
+        "pool_file": args.output or reg_cfg["pool_file"], "wall_s": round(wall, 3),
+        "keys_per_sec": round(len(keys) / wall, 2) if wall else 0.0, "requests": registrar.requests,
+        "throttled": registrar.throttled, "connections": registrar.connections,
+        "errors": sorted(set(errors))[:5]
+    })
+    return EXIT_OK if keys and not errors else (EXIT_NO_RESULTS if not keys else EXIT_ERROR)
+
+def cmd_export(args) -> int:
+    app = WarpFusionElitePro(headless=True, quiet=args.quiet)
+    try:
+        keys = app.load_key_pool(args.keys)
+        if args.endpoints:
+            with open(args.endpoints, 'r') as f:
+                results = [ScanResult(**{k: v for k, v in entry.items() if k in ScanResult.__annotations__}) for entry in json.load(f)]
+        else:
+            packages = missing_dependencies(["numpy", "icmplib"])
+            if packages:
+                sys.stderr.write(f"error: missing dependencies, install with: pip install {' '.join(packages)}\n")
+                return EXIT_ERROR
+            app.open_trace()
+            try:
+                results = app.find_best_servers()
+            finally:
+                app.close_trace()
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        sys.stderr.write(f"error: {e}\n")
+        return EXIT_ERROR
+    if not keys or not results:
+        sys.stderr.write("error: need at least one key and one endpoint\n")
+        return EXIT_NO_RESULTS
+    start = time.perf_counter()
+    try:
+        manifest = app.export_fleet(keys, results, args.formats, args.output, args.per_key, args.bundle, args.workers)
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"error: {e}\n")
+        return EXIT_ERROR
+    wall = time.perf_counter() - start
+    _emit({
+        "keys": len(keys), "endpoints": len(results), "files": len(manifest),
+        "output": args.output or app.config["export"]["dir"], "bundle": args.bundle,
+        "wall_s": round(wall, 3), "files_per_sec": round(len(manifest) / wall, 1) if wall else 0.0
+    })
+    return EXIT_OK
+
+def cmd_bench(args) -> int:
+    packages = missing_dependencies(["numpy"] + (["cryptography"] if args.probe == "handshake" else []))
+    if packages:
+        sys.stderr.write(f"error: missing dependencies, install with: pip install {' '.join(packages)}\n")
+        return EXIT_ERROR
+    ports = WARP_PORTS[:args.ports]
+    handshake_key = os.urandom(32) if args.probe == "handshake" else None
+    farm = SimulatedFarm.generate(args.hosts, ports, args.alive_ports, seed=args.seed, dead_hosts=args.dead_hosts,
+                                  mtu=tuple(args.mtu) if args.mtu else None, handshake_key=handshake_key)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    app = WarpFusionElitePro(headless=True, quiet=True)
+    app.metrics.profile, app.metrics.trace_memory = args.profile, args.tracemalloc
+    app.config["history"]["enabled"] = False
+    app.config["mtu"]["probe"] = "udp"  # the farm simulates path MTU for UDP only
+    scan_cfg = app.config["scan"]
+    scan_cfg.update(top_n=args.top, samples=args.samples, strategy=args.strategy, workers=args.workers,
+                    stable_for=args.stop_when_stable, probe=args.probe, pipeline=not args.no_pipeline)
+    if handshake_key:
+        client_private, _ = app.generate_wg_keys()
+        farm_public = WireGuardResponder(handshake_key, host=None).public_key
+        app.warp_key = WarpKey(private_key=base64.b64encode(client_private).decode(), public_key=base64.b64encode(farm_public).decode(),
+                               client_id="AAAA", address_v4="172.16.0.2", address_v6="fd01::2", last_updated="")
+    if args.timeout is not None:
+        app.port_scan_timeout = args.timeout
+    app.open_trace(args.record)
+    reports = []
+    with farm:
+        for run in range(args.repeat):
+            app.controller = None if args.no_adaptive else app.create_controller(initial_timeout=args.timeout)
+            app.metrics.reset()
+            report = run_benchmark(app, farm, args.mode, ports)
+            report["run"] = run + 1
+            snapshot = app.metrics.snapshot()
+            report["phases"], report["strategy_report"] = snapshot["phases"], snapshot["strategy_report"]
+            report["controller"] = app.controller.snapshot(decisions=False) if app.controller is not None else None
+            app.export_metrics(args.metrics_prom, args.metrics_json)
+            reports.append(report)
+            _emit(report)
+    app.close_trace()
+    return EXIT_OK if all(r["found"] for r in reports) else EXIT_NO_RESULTS
+
+def add_metrics_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--metrics-prom", metavar="FILE", help="write a Prometheus textfile with phase timings and probe counters")
+    parser.add_argument("--metrics-json", metavar="FILE", help="write the same metrics as a JSON snapshot")
+    parser.add_argument("--profile", action="store_true", help=f"cProfile each scan phase into {LOG_DIR}/profile_<phase>.pstats")
+    parser.add_argument("--tracemalloc", action="store_true", help="record peak Python memory per scan phase")
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="WarpScanner.py", description=f"WarpFusion Elite Pro v{VERSION}")
+    parser.set_defaults(handler=cmd_interactive)
+    commands = parser.add_subparsers(dest="command")
+
+    scan = commands.add_parser("scan", help="non-interactive endpoint scan")
+    scan.add_argument("--format", choices=["ndjson", "json", "table"], default="ndjson",
+                      help="ndjson streams every discovered endpoint, then the ranked list")
+    scan.add_argument("--mode", choices=["endpoints", "ranges"])
+    scan.add_argument("--ranges", nargs="+", metavar="CIDR", help="sweep these CIDRs (implies --mode ranges)")
+    scan.add_argument("--ipv6", action="store_true")
+    scan.add_argument("--probe", choices=["ping", "handshake"])
+    scan.add_argument("--samples", type=int)
+    scan.add_argument("--strategy", choices=["halving", "exhaustive"])
+    scan.add_argument("--top", dest="top_n", type=int)
+    scan.add_argument("--workers", type=lambda v: v if v == "auto" else int(v),
+                      help="scanner processes for range sweeps (number or 'auto')")
+    scan.add_argument("--timeout", type=float,
+                      help="initial per-probe timeout in seconds (the adaptive controller tunes it from there)")
+    scan.add_argument("--stop-when-stable", dest="stable_for", type=float, metavar="SECONDS",
+                      help="end the port sweep once the top list has not changed for this long")
+    scan.add_argument("--no-history", action="store_true")
+    scan.add_argument("--no-adaptive", action="store_true")
+    scan.add_argument("--record", metavar="FILE", help="append every probe event to this trace file for 'replay'")
+    scan.add_argument("--quiet", action="store_true", help="suppress progress messages on stderr")
+    add_metrics_arguments(scan)
+    scan.set_defaults(handler=cmd_scan)
+
+    replay = commands.add_parser("replay", help="re-score and re-rank a recorded probe trace offline")
+    replay.add_argument("trace", metavar="FILE")
+    replay.add_argument("--format", choices=["ndjson", "json", "table"], default="ndjson")
+    replay.add_argument("--weights", type=float, nargs=3, metavar=("LATENCY", "LOSS", "JITTER"))
+    replay.add_argument("--latency-metric", choices=["mean", "percentile"])
+    replay.add_argument("--percentile", type=float)
+    replay.add_argument("--samples", type=int)
+    replay.add_argument("--strategy", choices=["halving", "exhaustive"])
+    replay.add_argument("--top", dest="top_n", type=int)
+    replay.add_argument("--quiet", action="store_true", help="suppress progress messages on stderr")
+    add_metrics_arguments(replay)
+    replay.set_defaults(handler=cmd_replay)
+
+    monitor = commands.add_parser("monitor", help="keep the best endpoint active, failing over to warm standbys")
+    monitor.add_argument("--config-format", choices=["wg", "sing-box", "v2ray"], default="wg")
+    monitor.add_argument("--ranges", nargs="+", metavar="CIDR", help="initial sweep over these CIDRs instead of the endpoint list")
+    monitor.add_argument("--probe", choices=["ping", "handshake"], default="handshake",
+                         help="WARP peers only answer a WireGuard handshake; ping suits test echo servers")
+    monitor.add_argument("--interval", type=float, help="seconds between health rounds")
+    monitor.add_argument("--standby", type=int, help="warm standby endpoints to keep probing")
+    monitor.add_argument("--max-latency", type=float, help="fail over above this latency (ms)")
+    monitor.add_argument("--max-loss", type=float, help="fail over above this packet loss (%%)")
+    monitor.add_argument("--reload-command", help="shell command run after a rewrite; {config} is the primary config path")
+    monitor.add_argument("--quiet", action="store_true", help="suppress progress messages on stderr")
+    add_metrics_arguments(monitor)
+    monitor.set_defaults(handler=cmd_monitor)
+
+    keys = commands.add_parser("keys", help="generate and register a batch of Warp keys into the key pool")
+    keys.add_argument("--count", type=int, default=10)
+    keys.add_argument("--workers", type=int, help="concurrent keep-alive connections")
+    keys.add_argument("--rate", type=float, help="registrations per second before 429 backoff")
+    keys.add_argument("--burst", type=int)
+    keys.add_argument("--api", help=f"registration endpoint (default {CF_API})")
+    keys.add_argument("--output", metavar="FILE", help=f"key pool file (default {KEY_POOL_FILE})")
+    keys.add_argument("--mock", action="store_true", help="register against a local mock API instead of Cloudflare")
+    keys.add_argument("--mock-rate", type=float, default=20.0, help="mock API rate limit (req/s)")
+    keys.add_argument("--mock-latency", type=float, default=0.05, help="mock API response delay (s)")
+    keys.add_argument("--quiet", action="store_true", help="suppress progress messages on stderr")
+    keys.set_defaults(handler=cmd_keys)
+
+    export = commands.add_parser("export", help="write configs for every key in the pool across the ranked endpoints")
+    export.add_argument("--keys", metavar="FILE", help=f"key pool file (default {KEY_POOL_FILE})")
+    export.add_argument("--endpoints", metavar="FILE", help="ranked endpoints from 'scan --format json' (default: run a scan)")
+    export.add_argument("--formats", nargs="+", choices=["wg", "sing-box", "v2ray"])
+    export.add_argument("--per-key", type=int, help="endpoints assigned to each key")
+    export.add_argument("--output", metavar="DIR", help="output directory (one subdirectory per key)")
+    export.add_argument("--bundle", metavar="FILE", help="also write one base64 subscription of wireguard:// links")
+    export.add_argument("--workers", type=int, help="parallel file writers")
+    export.add_argument("--quiet", action="store_true", help="suppress scan progress messages on stderr")
+    export.set_defaults(handler=cmd_export)
+
+    bench = commands.add_parser("bench", help="offline benchmark against a simulated loopback endpoint farm")
+    bench.add_argument("--hosts", type=int, default=64)
+    bench.add_argument("--ports", type=int, default=len(WARP_PORTS), help="scan the first N of WARP_PORTS")
+    bench.add_argument("--alive-ports", type=int, default=4, help="live ports per host")
+    bench.add_argument("--dead-hosts", type=float, default=0.2, help="fraction of hosts with no live ports")
+    bench.add_argument("--mode", choices=["endpoints", "ranges"], default="endpoints")
+    bench.add_argument("--no-pipeline", action="store_true", help="endpoints mode: ping every host before port probing")
+    bench.add_argument("--strategy", choices=["halving", "exhaustive"], default="halving")
+    bench.add_argument("--probe", choices=["ping", "handshake"], default="ping",
+                       help="handshake turns every farm endpoint into a WireGuard responder")
+    bench.add_argument("--samples", type=int, default=8)
+    bench.add_argument("--top", type=int, default=10)
+    bench.add_argument("--timeout", type=float,
+                       help="initial per-probe timeout in seconds (the adaptive controller tunes it from there)")
+    bench.add_argument("--mtu", type=int, nargs=2, metavar=("MIN", "MAX"),
+                       help="give each simulated endpoint a path MTU in this range and check discovery")
+    bench.add_argument("--no-adaptive", action="store_true")
+    bench.add_argument("--stop-when-stable", type=float, default=0.0, metavar="SECONDS",
+                       help="end the sweep once the top list has not changed for this long")
+    bench.add_argument("--workers", type=lambda v: v if v == "auto" else int(v), default=1,
+                       help="scanner processes (ranges mode)")
+    bench.add_argument("--repeat", type=int, default=1)
+    bench.add_argument("--seed", type=int, default=1)
+    bench.add_argument("--record", metavar="FILE", help="append every probe event to this trace file for 'replay'")
+    add_metrics_arguments(bench)
+    bench.set_defaults(handler=cmd_bench)
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    try:
+        return args.handler(args)
+    except KeyboardInterrupt:
+        sys.stderr.write("\n⚠️ Interrupted by user.\n")
+        return EXIT_INTERRUPTED
+    except Exception as e:
+        sys.stderr.write(f"error: {type(e).__name__}: {e}\n")
+        return EXIT_ERROR
+
+if __name__ == "__main__":
+    sys.exit(main())
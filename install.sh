@@ -52,7 +52,7 @@ setup_ubuntu() {
     proot-distro login ubuntu -- bash -c "
         apt update && apt upgrade -y
         apt install -y python3 python3-pip git curl wget
-        pip3 install --break-system-packages requests cryptography icmplib psutil pyyaml rich alive_progress
+        pip3 install --break-system-packages requests cryptography icmplib psutil pyyaml rich alive_progress numpy
     " || {
         echo -e "${RED}❌ خطا در نصب پیش‌نیازها${NC}"
         exit 1